@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013:
+#     Sébastien Pasche, sebastien.pasche@leshop.ch
+#     Benoit Chalut, benoit.chalut@leshop.ch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Offline benchmark of the check_nodes_openshift.py phases.
+
+The broker is a local paramiko SSH server answering
+`oo-mco rpc rpcutil ping -j -I ...` with a configurable latency and failure
+rate. It runs in its own process so its CPU is not counted. MongoDB is an
+in-process stand-in seeded with one district per requested size, it only
+understands the queries the check sends. There is no real connection,
+server side query nor BSON decoding : load_district only measures the
+python side of the district loading, not the MongoDB cost.
+
+For every district size and ping mode the wall time, CPU time and peak
+python memory of each phase are reported. The measures can be written to a
+json file with --json and a later run compared to it with --baseline : the
+run fails when the CPU time of a phase grew more than --tolerance. The CPU
+time is compared because the wall time mostly follows the simulated broker
+latency.
+"""
+
+import sys
+import os
+import re
+import copy
+import json
+import time
+import random
+import shlex
+import socket
+import optparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import paramiko
+
+import check_nodes_openshift
+from openshift_checks import SSHHelper
+
+
+#Simulated broker
+#----------------
+
+class BrokerStub(paramiko.ServerInterface):
+    """
+    SSH server accepting any key and answering the mco rpcutil ping
+    commands
+    """
+
+    def __init__(
+            self,
+            latency,
+            failure_rate
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(
+            target=self.answer,
+            args=(channel, command.decode('utf-8'))
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def answer(
+            self,
+            channel,
+            command
+    ):
+        args = shlex.split(command)
+        identities = [args[i + 1] for i, arg in enumerate(args) if arg == '-I']
+
+        # mco discovery and rpc round trip
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        replies = [
+            {
+                'sender': identity,
+                'statuscode': 0,
+                'statusmsg': 'OK',
+                'agent': 'rpcutil',
+                'action': 'ping',
+                'data': {'pong': int(time.time())}
+            } for identity in identities if random.random() >= self.failure_rate
+        ]
+        try:
+            channel.sendall(json.dumps(replies, indent=2).encode('utf-8'))
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+
+def serve_broker(
+        port_pipe,
+        latency,
+        failure_rate
+):
+    """
+    Run the simulated broker, the listening port is sent through port_pipe
+    """
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(100)
+    port_pipe.send(listener.getsockname()[1])
+
+    while True:
+        sock, address = listener.accept()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.start_server(server=BrokerStub(latency, failure_rate))
+
+
+#Simulated mongodb
+#-----------------
+
+class DistrictsCollectionStub(object):
+    """
+    districts collection stand-in, understanding the name, $in and $regex
+    queries, the servers projections and the servers count aggregation
+    """
+
+    def __init__(
+            self,
+            districts
+    ):
+        self.districts = districts
+
+    def _match(
+            self,
+            query
+    ):
+        name_query = query.get('name')
+        for district in self.districts:
+            if name_query is None:
+                yield district
+            elif isinstance(name_query, dict):
+                if '$in' in name_query and district['name'] in name_query['$in']:
+                    yield district
+                elif '$regex' in name_query and re.search(name_query['$regex'], district['name']):
+                    yield district
+            elif district['name'] == name_query:
+                yield district
+
+    def _project(
+            self,
+            district,
+            projection
+    ):
+        server_fields = [
+            field.split('.', 1)[1] for field in projection if field.startswith('servers.')
+        ]
+        if 'servers' in projection or not server_fields:
+            return copy.deepcopy(district)
+        return {
+            '_id': district['_id'],
+            'name': district['name'],
+            'servers': [
+                {field: server[field] for field in server_fields if field in server}
+                for server in district['servers']
+            ]
+        }
+
+    def find_one(
+            self,
+            query,
+            projection=None
+    ):
+        for district in self._match(query):
+            return self._project(district, projection or {})
+        return None
+
+    def find(
+            self,
+            query,
+            projection=None
+    ):
+        return CursorStub(
+            self._project(district, projection or {}) for district in self._match(query)
+        )
+
+    def aggregate(
+            self,
+            pipeline
+    ):
+        return [
+            {
+                '_id': district['name'],
+                'active': sum(bool(server['active']) for server in district['servers']),
+                'unresponsive': sum(bool(server['unresponsive']) for server in district['servers']),
+                'inactive_names': [
+                    server['name'] for server in district['servers'] if not server['active']
+                ],
+                'unresponsive_names': [
+                    server['name'] for server in district['servers'] if server['unresponsive']
+                ]
+            } for district in self._match(pipeline[0]['$match'])
+            if district['servers']
+        ]
+
+
+class CursorStub(list):
+
+    def sort(self, key, direction=1):
+        return CursorStub(sorted(self, key=lambda d: d[key], reverse=direction < 0))
+
+    def batch_size(self, size):
+        return self
+
+
+def seed_districts(
+        sizes,
+        unresponsive_rate=0.01
+):
+    """
+    :param sizes: list of district sizes
+    :return: dict used as the openshift database, with one district per size
+    """
+    districts = []
+    for size in sizes:
+        name = 'district{s}'.format(s=size)
+        servers = []
+        for i in range(size):
+            unresponsive = random.random() < unresponsive_rate
+            servers.append({
+                'name': 'node{i}.{d}.example.com'.format(i=i, d=name),
+                'active': not unresponsive,
+                'unresponsive': unresponsive,
+                'district_uuid': '{d}-uuid'.format(d=name),
+                'max_gears': 100,
+                'region_id': 'region1',
+                'zone_id': 'zone{z}'.format(z=i % 3)
+            })
+        districts.append({
+            '_id': name,
+            'name': name,
+            'uuid': '{d}-uuid'.format(d=name),
+            'max_capacity': size * 100,
+            'servers': servers
+        })
+    return {'districts': DistrictsCollectionStub(districts)}
+
+
+#Measures
+#--------
+
+def measure(
+        phase,
+        measures,
+        function,
+        *args,
+        **kwargs
+):
+    """
+    Call function and append its wall time, CPU time and python peak memory
+    to measures
+    """
+    tracemalloc.reset_peak()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    result = function(*args, **kwargs)
+
+    measures.append({
+        'phase': phase,
+        'wall_ms': (time.perf_counter() - wall_start) * 1000,
+        'cpu_ms': (time.process_time() - cpu_start) * 1000,
+        'peak_kib': (tracemalloc.get_traced_memory()[1] - memory_start) / 1024.0
+    })
+    return result
+
+
+def bench_district(
+        size,
+        mode,
+        broker_port,
+        key_file,
+        mongodb_db,
+        workers
+):
+    """
+    Run the check phases for one district
+    :return: list of phase measures
+    """
+    measures = []
+    mco_ping_options = {
+        'sequential': {},
+        'parallel': {'workers': workers},
+        'batch': {'batch_size': 200},
+    }[mode]
+
+    client = measure(
+        'ssh_connect',
+        measures,
+        SSHHelper.connect,
+        hostname='127.0.0.1',
+        port=broker_port,
+        ssh_key_file=key_file,
+        passphrase='',
+        user='shinken'
+    )
+    district = measure(
+        'load_district',
+        measures,
+        check_nodes_openshift.load_districts,
+        mongodb_db,
+        district_names=['district{s}'.format(s=size)]
+    )[0]
+    mco_status = measure(
+        'mco_ping',
+        measures,
+        check_nodes_openshift.nodes_mco_ping_status,
+        client,
+        district,
+        **mco_ping_options
+    )
+    measure(
+        'district_check',
+        measures,
+        check_nodes_openshift.district_check,
+        client,
+        district,
+        district['name'],
+        check_nodes_openshift.DEFAULT_WARNING,
+        check_nodes_openshift.DEFAULT_CRITICAL,
+        mco_servers_status=mco_status
+    )
+    client.close()
+
+    total = {
+        'phase': 'total',
+        'wall_ms': sum(m['wall_ms'] for m in measures),
+        'cpu_ms': sum(m['cpu_ms'] for m in measures),
+        'peak_kib': max(m['peak_kib'] for m in measures)
+    }
+    return measures + [total]
+
+
+def compare_baseline(
+        results,
+        baseline,
+        tolerance,
+        min_delta_ms
+):
+    """
+    :param results: measures of this run
+    :param baseline: measures of a previous run, as written by --json
+    :param tolerance: allowed CPU time growth ratio
+    :param min_delta_ms: CPU time growth always allowed, the short phases
+    vary more than the tolerance between two runs
+    :return: list of failure messages
+    """
+    baseline_cpu = {
+        (m['size'], m['mode'], m['phase']): m['cpu_ms'] for m in baseline
+    }
+    failures = []
+    for m in results:
+        key = (m['size'], m['mode'], m['phase'])
+        if key not in baseline_cpu:
+            continue
+        limit = max(baseline_cpu[key] * (1 + tolerance), baseline_cpu[key] + min_delta_ms)
+        if m['cpu_ms'] > limit:
+            failures.append(
+                "{s} nodes {mode} {p} takes {t:.1f} ms of CPU, baseline {b:.1f} ms".format(
+                    s=m['size'],
+                    mode=m['mode'],
+                    p=m['phase'],
+                    t=m['cpu_ms'],
+                    b=baseline_cpu[key]
+                )
+            )
+    return failures
+
+
+parser = optparse.OptionParser("%prog [options]")
+parser.add_option('--sizes',
+                  dest="sizes", default='10,100,1000,10000',
+                  help='Comma separated district sizes. Default : 10,100,1000,10000')
+parser.add_option('--modes',
+                  dest="modes", default='parallel,batch',
+                  help='Comma separated ping modes among sequential, parallel and batch. '
+                       'Default : parallel,batch')
+parser.add_option('--workers',
+                  dest="workers", type="int", default=10,
+                  help='Workers of the parallel mode. Default : 10')
+parser.add_option('--latency',
+                  dest="latency", type="float", default=0.05,
+                  help='Mean seconds the simulated broker takes per mco call. Default : 0.05')
+parser.add_option('--failure-rate',
+                  dest="failure_rate", type="float", default=0.01,
+                  help='Ratio of nodes not answering the mco ping. Default : 0.01')
+parser.add_option('--json',
+                  dest="json_file", default=None,
+                  help='Also write the measures to this json file')
+parser.add_option('--baseline',
+                  dest="baseline", default=None,
+                  help='Fail when a phase takes more CPU time than in this json file')
+parser.add_option('--tolerance',
+                  dest="tolerance", type="float", default=0.25,
+                  help='Allowed CPU time growth ratio against the baseline. Default : 0.25')
+parser.add_option('--min-delta',
+                  dest="min_delta", type="float", default=5,
+                  help='CPU milliseconds a phase may always grow against the baseline. Default : 5')
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+    sizes = [int(size) for size in opts.sizes.split(',')]
+    modes = opts.modes.split(',')
+
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    broker = multiprocessing.Process(
+        target=serve_broker,
+        args=(child_pipe, opts.latency, opts.failure_rate)
+    )
+    broker.daemon = True
+    broker.start()
+    broker_port = parent_pipe.recv()
+
+    key_dir = tempfile.mkdtemp()
+    key_file = os.path.join(key_dir, 'id_rsa')
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_file)
+
+    mongodb_db = seed_districts(sizes)
+
+    tracemalloc.start()
+    results = []
+    print("{s:>7} {m:10} {p:15} {w:>10} {c:>10} {k:>10}".format(
+        s='nodes', m='mode', p='phase', w='wall ms', c='cpu ms', k='peak KiB'
+    ))
+    for size in sizes:
+        for mode in modes:
+            for measure_ in bench_district(size, mode, broker_port, key_file, mongodb_db, opts.workers):
+                measure_.update(size=size, mode=mode)
+                results.append(measure_)
+                print("{size:>7} {mode:10} {phase:15} {wall_ms:10.1f} {cpu_ms:10.1f} {peak_kib:10.1f}".format(
+                    **measure_
+                ))
+
+    if opts.json_file:
+        with open(opts.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    broker.terminate()
+
+    failures = []
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        failures = compare_baseline(results, baseline, opts.tolerance, opts.min_delta)
+
+    for failure in failures:
+        print("FAIL : {f}".format(f=failure))
+    sys.exit(1 if failures else 0)
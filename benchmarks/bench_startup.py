@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013:
+#     Sébastien Pasche, sebastien.pasche@leshop.ch
+#     Benoit Chalut, benoit.chalut@leshop.ch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Measure the cold start time of the check plugin and guard it against
+regressions.
+
+Each scenario runs in a fresh interpreter. The median wall time can be
+recorded to a json file and later runs compared to it. The run also fails
+when a module that must stay lazy is loaded at startup.
+"""
+
+import sys
+import os
+import json
+import optparse
+import subprocess
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+check_script = os.path.join(repo_dir, 'check_nodes_openshift.py')
+
+#Modules only the functions needing them may import
+LAZY_MODULES = [
+    'paramiko',
+    'pymongo',
+    'asyncio',
+    'concurrent.futures',
+    'http.server',
+    'urllib.request',
+    'subprocess',
+]
+
+SCENARIOS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'import': [sys.executable, '-c', 'import check_nodes_openshift'],
+    'help': [sys.executable, check_script, '--help'],
+}
+
+
+def run_scenario(
+        cmd,
+        runs
+):
+    """
+    Run cmd runs times in a fresh interpreter
+
+    :param cmd: command argument list
+    :param runs: number of runs
+    :return: median wall time in milliseconds
+    """
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(
+            cmd,
+            cwd=repo_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def loaded_lazy_modules():
+    """
+    :return: list of the LAZY_MODULES loaded by importing the plugin
+    """
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            '-c',
+            'import sys, json, check_nodes_openshift; '
+            'print(json.dumps(sorted(sys.modules)))'
+        ],
+        cwd=repo_dir,
+        universal_newlines=True
+    )
+    modules = set(json.loads(output))
+    return [m for m in LAZY_MODULES if m in modules]
+
+
+parser = optparse.OptionParser("%prog [options]")
+parser.add_option('--runs',
+                  dest="runs", type="int", default=10,
+                  help='Runs per scenario. Default : 10')
+parser.add_option('--record',
+                  dest="record", default=None,
+                  help='Write the measured times to this json file')
+parser.add_option('--baseline',
+                  dest="baseline", default=None,
+                  help='Fail when a scenario is slower than in this json file')
+parser.add_option('--tolerance',
+                  dest="tolerance", type="float", default=0.25,
+                  help='Allowed slowdown ratio against the baseline. Default : 0.25')
+
+if __name__ == '__main__':
+    opts, args = parser.parse_args()
+
+    failures = []
+
+    lazy = loaded_lazy_modules()
+    if lazy:
+        failures.append("modules loaded at startup : {m}".format(m=', '.join(lazy)))
+
+    results = {}
+    for name in sorted(SCENARIOS):
+        results[name] = run_scenario(SCENARIOS[name], opts.runs)
+        print("{n:10} {t:8.1f} ms".format(n=name, t=results[name]))
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        for name, timing in sorted(results.items()):
+            if name == 'python' or name not in baseline:
+                continue
+            # compare the plugin own cost, without the interpreter start
+            own = timing - results['python']
+            baseline_own = baseline[name] - baseline.get('python', 0)
+            if own > baseline_own * (1 + opts.tolerance):
+                failures.append(
+                    "{n} takes {t:.1f} ms over the interpreter start, baseline {b:.1f} ms".format(
+                        n=name,
+                        t=own,
+                        b=baseline_own
+                    )
+                )
+
+    if opts.record:
+        with open(opts.record, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for failure in failures:
+        print("FAIL : {f}".format(f=failure))
+    sys.exit(1 if failures else 0)
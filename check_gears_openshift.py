@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2013:
+#     Sébastien Pasche, sebastien.pasche@leshop.ch
+#     Benoit Chalut, benoit.chalut@leshop.ch
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+
+author = "Sebastien Pasche"
+maintainer = "Sebastien Pasche"
+version = "0.0.1"
+
+import sys
+import optparse
+import os
+import traceback
+
+from pprint import pprint
+
+try:
+    from openshift_checks import MongoDBHelper, OutputFormatHelpers
+except ImportError:
+    #Ok try to load our directory to load the plugin utils.
+    my_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, my_dir)
+    try:
+        from openshift_checks import MongoDBHelper, OutputFormatHelpers
+    except ImportError:
+        print("ERROR : this plugin needs the local openshift_checks lib. Please install it")
+        sys.exit(2)
+
+#DEFAULT LIMITS
+#--------------
+#gear usage of the district max capacity, in percent
+DEFAULT_WARNING = 80
+DEFAULT_CRITICAL = 90
+
+#applications, or aggregated placements, read per cursor batch
+DEFAULT_STREAM_BATCH_SIZE = 1000
+
+
+def openshift_districts_capacity(
+        mongodb_db_connection,
+        district_names=None,
+        district_pattern=None,
+        debug=False
+):
+    """
+    Load the capacity and the node names of the districts
+
+    :param mongodb_db_connection:
+    :param district_names: list of district names
+    :param district_pattern: regular expression the district names must match
+    :return: list of district dict sorted by name
+    """
+    collection = mongodb_db_connection['districts']
+
+    districts = list(
+        collection.find(
+            MongoDBHelper.districts_query(district_names, district_pattern),
+            {
+                'name': 1,
+                'max_capacity': 1,
+                'available_capacity': 1,
+                'servers.name': 1
+            }
+        ).sort('name', 1)
+    )
+
+    if debug:
+        print("The districts capacity")
+        pprint(districts)
+
+    if not districts:
+        raise Exception("No openshift district found")
+
+    missing = set(district_names or []) - set(district['name'] for district in districts)
+    if missing:
+        raise Exception("Unknown openshift district {d}".format(d=', '.join(sorted(missing))))
+
+    return districts
+
+
+def aggregate_gears_placements(
+        mongodb_db_connection,
+        server_names,
+        batch_size=DEFAULT_STREAM_BATCH_SIZE,
+        debug=False
+):
+    """
+    Count the gears of each application on each server inside mongodb with
+    an aggregation pipeline, sorted by application
+
+    :param mongodb_db_connection:
+    :param server_names: list of the server identities to count
+    :param batch_size: placements read per cursor batch
+    :return: generator of (application id, server identity, number of gears)
+    """
+    collection = mongodb_db_connection['applications']
+
+    server_filter = {
+        'gears.server_identity': {
+            '$in': list(server_names)
+        }
+    }
+    pipeline = [
+        {
+            '$match': server_filter
+        },
+        {
+            '$project': {
+                'gears.server_identity': 1
+            }
+        },
+        {
+            '$unwind': '$gears'
+        },
+        {
+            '$match': server_filter
+        },
+        {
+            '$group': {
+                '_id': {
+                    'application': '$_id',
+                    'server': '$gears.server_identity'
+                },
+                'gears': {'$sum': 1}
+            }
+        },
+        {
+            '$sort': {
+                '_id.application': 1
+            }
+        }
+    ]
+
+    if debug:
+        print("The gears placements pipeline")
+        pprint(pipeline)
+
+    for placement in collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        yield placement['_id']['application'], placement['_id']['server'], placement['gears']
+
+
+def stream_gears_placements(
+        mongodb_db_connection,
+        server_names,
+        batch_size=DEFAULT_STREAM_BATCH_SIZE,
+        debug=False
+):
+    """
+    Stream the server identities of the applications gears in batches
+
+    :param mongodb_db_connection:
+    :param server_names: list of the server identities to count
+    :param batch_size: applications read per cursor batch
+    :return: generator of (application id, server identity, 1)
+    """
+    collection = mongodb_db_connection['applications']
+
+    cursor = collection.find(
+        {
+            'gears.server_identity': {
+                '$in': list(server_names)
+            }
+        },
+        {
+            'gears.server_identity': 1
+        }
+    ).batch_size(batch_size)
+
+    nb_applications = 0
+    for application in cursor:
+        nb_applications += 1
+        for gear in application.get('gears', []):
+            yield application['_id'], gear.get('server_identity'), 1
+
+    if debug:
+        print("{nb} applications streamed".format(nb=nb_applications))
+
+
+def gears_counts(
+        placements,
+        servers_district
+):
+    """
+    Count the gears and the applications of each server and the applications
+    of each district. Only the counters are kept, the memory does not grow
+    with the number of applications
+
+    :param placements: iterable of (application id, server identity, number
+    of gears), the placements of an application must follow each other
+    :param servers_district: dict of server identity -> district name, the
+    other servers are ignored
+    :return: dict of server identity -> {'gears': nb, 'applications': nb},
+    dict of district name -> number of applications
+    """
+    servers_counts = {}
+    districts_applications = {}
+
+    current_application = None
+    application_servers = set()
+    application_districts = set()
+    for application, server, gears in placements:
+        if application != current_application:
+            current_application = application
+            application_servers = set()
+            application_districts = set()
+
+        district = servers_district.get(server)
+        if district is None:
+            continue
+
+        counts = servers_counts.setdefault(server, {'gears': 0, 'applications': 0})
+        counts['gears'] += gears
+        if server not in application_servers:
+            application_servers.add(server)
+            counts['applications'] += 1
+        if district not in application_districts:
+            application_districts.add(district)
+            districts_applications[district] = districts_applications.get(district, 0) + 1
+
+    return servers_counts, districts_applications
+
+
+def district_gears_check(
+        district,
+        servers_gears,
+        nb_applications,
+        warning,
+        critical,
+        node_perfdata=False
+):
+    """
+    Check the gear usage of one district against its max capacity
+
+    :param district: district dict with its name, max_capacity and server names
+    :param servers_gears: dict of server identity -> gears and applications counts
+    :param nb_applications: number of applications with gears in the district
+    :param warning: warning gear usage, in percent of the max capacity
+    :param critical: critical gear usage, in percent of the max capacity
+    :param node_perfdata: also report the gears and applications of each node
+    :return: dict with the district name, status, message and perf data list
+    """
+    district_name = district['name']
+    max_capacity = district.get('max_capacity') or 0
+
+    no_gears = {'gears': 0, 'applications': 0}
+    nodes_gears = [
+        (server['name'], servers_gears.get(server['name'], no_gears))
+        for server in district.get('servers', [])
+    ]
+    nb_gears = sum(counts['gears'] for name, counts in nodes_gears)
+
+    perfdata = [
+        OutputFormatHelpers.perf_data_string(
+            label="{d}_gears".format(d=district_name),
+            value=nb_gears,
+            warn=int(max_capacity * warning / 100) if max_capacity else '',
+            crit=int(max_capacity * critical / 100) if max_capacity else '',
+            min=0,
+            max=max_capacity or ''
+        ),
+        OutputFormatHelpers.perf_data_string(
+            label="{d}_applications".format(d=district_name),
+            value=nb_applications,
+            min=0
+        )
+    ]
+
+    #check
+    if max_capacity:
+        usage = round(nb_gears * 100.0 / max_capacity, 1)
+        perfdata.append(
+            OutputFormatHelpers.perf_data_string(
+                label="{d}_gears_usage".format(d=district_name),
+                value=usage,
+                warn=warning,
+                crit=critical,
+                UOM='%',
+                min=0,
+                max=100
+            )
+        )
+        status = "OK"
+        if usage >= warning:
+            status = "Warning"
+        if usage >= critical:
+            status = "Critical"
+        message = "{g} gears of {m} ({u}%), {a} applications on {n} nodes".format(
+            g=nb_gears,
+            m=max_capacity,
+            u=usage,
+            a=nb_applications,
+            n=len(nodes_gears)
+        )
+    else:
+        status = "Unknown"
+        message = "{g} gears, {a} applications on {n} nodes, no max capacity".format(
+            g=nb_gears,
+            a=nb_applications,
+            n=len(nodes_gears)
+        )
+
+    if 'available_capacity' in district:
+        perfdata.append(
+            OutputFormatHelpers.perf_data_string(
+                label="{d}_available_capacity".format(d=district_name),
+                value=district['available_capacity'],
+                min=0,
+                max=max_capacity or ''
+            )
+        )
+
+    if node_perfdata:
+        for name, counts in nodes_gears:
+            perfdata += [
+                OutputFormatHelpers.perf_data_string(
+                    label="{n}_gears".format(n=name),
+                    value=counts['gears'],
+                    min=0
+                ),
+                OutputFormatHelpers.perf_data_string(
+                    label="{n}_applications".format(n=name),
+                    value=counts['applications'],
+                    min=0
+                )
+            ]
+
+    return {
+        'name': district_name,
+        'status': status,
+        'message': message,
+        'perfdata': perfdata
+    }
+
+
+def districts_gears_check(
+        mongodb_db_connection,
+        warning,
+        critical,
+        district_names=None,
+        district_pattern=None,
+        stream=False,
+        stream_batch_size=DEFAULT_STREAM_BATCH_SIZE,
+        node_perfdata=False,
+        debug=False
+):
+    """
+    Count the gears of all the checked districts nodes at once, then check
+    each district
+
+    :param stream: stream the applications instead of counting the gears
+    with an aggregation pipeline
+    :param stream_batch_size: applications, or aggregated placements, read
+    per cursor batch
+    :return: list of district_gears_check results
+    """
+    districts = openshift_districts_capacity(
+        mongodb_db_connection,
+        district_names,
+        district_pattern,
+        debug
+    )
+
+    servers_district = {
+        server['name']: district['name']
+        for district in districts for server in district.get('servers', [])
+    }
+    placements = (stream_gears_placements if stream else aggregate_gears_placements)(
+        mongodb_db_connection,
+        list(servers_district),
+        stream_batch_size,
+        debug
+    )
+    servers_gears, districts_applications = gears_counts(placements, servers_district)
+
+    if debug:
+        print("The servers gears count")
+        pprint(servers_gears)
+
+    return [
+        district_gears_check(
+            district,
+            servers_gears,
+            districts_applications.get(district['name'], 0),
+            warning,
+            critical,
+            node_perfdata
+        ) for district in districts
+    ]
+
+
+# OPT parsing
+# -----------
+parser = optparse.OptionParser(
+    "%prog [options]", version="%prog " + version)
+
+#mongodb connection
+parser.add_option('--mongo-hostname',
+                  dest="mongo_hostnames",
+                  help='space separated mongodb hostnames:port list to connect to. '
+                       'Example :  "server1:27017 server2:27017" ')
+parser.add_option('--mongo-user',
+                  dest="mongo_user", default="shinken",
+                  help='remote use to use. By default shinken.')
+parser.add_option('--mongo-password',
+                  dest="mongo_password",
+                  help='Password. By default will use void')
+parser.add_option('--mongo-source-longon',
+                  dest="mongo_source", default='admin',
+                  help='Source where to log on. Default: admin')
+parser.add_option('--mongo-replicaset',
+                  dest="mongo_replicaset",
+                  help='openshift current mongodb replicaset')
+parser.add_option('--mongo-openshift-database-name',
+                  dest="mongo_openshift_database",
+                  help='openshift current database')
+parser.add_option('--mongo-read-preference',
+                  dest="mongo_read_preference", default='primary',
+                  help='Read preference of the district and application queries, e.g. secondaryPreferred. '
+                       'Default : primary')
+parser.add_option('--mongo-connect-timeout',
+                  dest="mongo_connect_timeout", type="float", default=5,
+                  help='Seconds to wait for a mongodb connection. Default : 5')
+parser.add_option('--mongo-server-selection-timeout',
+                  dest="mongo_server_selection_timeout", type="float", default=10,
+                  help='Seconds to wait for a suitable mongodb server. Default : 10')
+parser.add_option('--mongo-stream',
+                  dest="mongo_stream", default=False, action="store_true",
+                  help='Stream the applications gears in batches instead of counting them '
+                       'with an aggregation pipeline, e.g. when aggregation is not allowed')
+parser.add_option('--mongo-stream-batch-size',
+                  dest="mongo_stream_batch_size", type="int", default=DEFAULT_STREAM_BATCH_SIZE,
+                  help='Applications, or aggregated placements, read per cursor batch. Default : 1000')
+
+#openshift relative
+parser.add_option('--openshift-district-name',
+                  dest="openshift_district",
+                  help='openshift district to check. A comma separated list checks '
+                       'several districts in one run')
+parser.add_option('--openshift-all-districts',
+                  dest="openshift_all_districts", default=False, action="store_true",
+                  help='Check all the openshift districts in one run')
+parser.add_option('--openshift-district-pattern',
+                  dest="openshift_district_pattern", default=None,
+                  help='Check all the openshift districts matching this regular expression')
+parser.add_option('--node-perfdata',
+                  dest="node_perfdata", default=False, action="store_true",
+                  help='Also report the gears and applications of each node as perf data')
+parser.add_option('-w', '--warning',
+                  dest="warning", type="float", default=None,
+                  help='Warning gear usage of a district, in percent of its max capacity. Default : 80')
+parser.add_option('-c', '--critical',
+                  dest="critical", type="float", default=None,
+                  help='Critical gear usage of a district, in percent of its max capacity. Default : 90')
+
+#generic
+parser.add_option('--debug',
+                  dest="debug", default=False, action="store_true",
+                  help='Enable debug')
+
+if __name__ == '__main__':
+
+    # Ok first job : parse args
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("Does not accept any argument.")
+
+    #MongpDB args
+    #------------
+
+    # get mongodb server list
+    if opts.mongo_hostnames is None:
+        raise Exception("You must specify a mongodb servers list")
+
+    # get mongodb user password
+    if opts.mongo_password is None:
+        raise Exception("You must specify a mongodb user password")
+
+    # get mongodb openshift database name
+    if opts.mongo_openshift_database is None:
+        raise Exception("You must specify a mongodb openshift database name")
+
+    # get mongodb database replicaset
+    if opts.mongo_replicaset is None:
+        raise Exception("You must specify a mongodb database replicaset name")
+
+    if opts.mongo_stream_batch_size <= 0:
+        raise Exception("The stream batch size must be greater than 0")
+
+    #Openshift related args
+    #----------------------
+
+    #Get district name(s)
+    openshift_district_names = []
+    if opts.openshift_district:
+        openshift_district_names = [
+            name.strip() for name in opts.openshift_district.split(',') if name.strip()
+        ]
+    if not (openshift_district_names or opts.openshift_all_districts or opts.openshift_district_pattern):
+        raise Exception("You must specify a openshift district name")
+
+    multi_district = (
+        len(openshift_district_names) > 1 or
+        opts.openshift_all_districts or
+        opts.openshift_district_pattern is not None
+    )
+
+    s_warning = opts.warning if opts.warning is not None else DEFAULT_WARNING
+    s_critical = opts.critical if opts.critical is not None else DEFAULT_CRITICAL
+
+    debug = opts.debug
+
+    status = "Critical"
+    mongodb_client = None
+
+    try:
+        #Connecto to MongoDB
+        #-------------------
+        mongodb_client = MongoDBHelper.get_mongodb_client(
+            mongodb_servers=opts.mongo_hostnames.split(' '),
+            replicaset=opts.mongo_replicaset,
+            username=opts.mongo_user,
+            password=opts.mongo_password,
+            source=opts.mongo_source,
+            read_preference=opts.mongo_read_preference,
+            connect_timeout=opts.mongo_connect_timeout,
+            server_selection_timeout=opts.mongo_server_selection_timeout
+        )
+
+        results = districts_gears_check(
+            mongodb_client[opts.mongo_openshift_database],
+            s_warning,
+            s_critical,
+            district_names=openshift_district_names,
+            district_pattern=opts.openshift_district_pattern,
+            stream=opts.mongo_stream,
+            stream_batch_size=opts.mongo_stream_batch_size,
+            node_perfdata=opts.node_perfdata,
+            debug=debug
+        )
+
+        #Format and print check result
+        status, output = OutputFormatHelpers.districts_check_output(
+            results,
+            multi_district
+        )
+        print(output)
+
+    except Exception as e:
+        if debug:
+            print(e)
+            the_type, value, tb = sys.exc_info()
+            traceback.print_tb(tb)
+        print("Error: {m}".format(m=e))
+        status = "Critical"
+
+    finally:
+        if mongodb_client is not None:
+            MongoDBHelper.close_mongodb_connection(mongodb_client)
+        sys.exit(OutputFormatHelpers.exit_code(status))
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # Copyright (C) 2013:
@@ -33,112 +33,708 @@ import optparse
 import os
 import traceback
 import json
+import re
+import shlex
+import socket
+import functools
+import heapq
+import math
+import threading
+import time
 
 from pprint import pprint
 
 #TODO : Move to asyncio_mongo
 
-try:
-    import paramiko
-except ImportError:
-    print("ERROR : this plugin needs the python-paramiko module. Please install it")
-    sys.exit(2)
-
-#Ok try to load our directory to load the plugin utils.
-my_dir = os.path.dirname(__file__)
-sys.path.insert(0, my_dir)
+# Keep the module load light : paramiko, pymongo, asyncio, concurrent.futures
+# and the http modules are imported by the functions using them.
 
 try:
-    from openshift_checks import MongoDBHelper, OutputFormatHelpers, SSHHelper
+    import openshift_checks
 except ImportError:
-    print("ERROR : this plugin needs the local openshift_checks lib. Please install it")
-    sys.exit(2)
+    #Ok try to load our directory to load the plugin utils.
+    my_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, my_dir)
+    try:
+        import openshift_checks
+    except ImportError:
+        print("ERROR : this plugin needs the local openshift_checks lib. Please install it")
+        sys.exit(2)
+
+from openshift_checks import (
+    BorrowedClient,
+    BrokerCallLimiter,
+    BrokerQueueTimeout,
+    CheckResult,
+    Deadline,
+    FileTTLCache,
+    MongoDBCollectionWatcher,
+    MongoDBHelper,
+    NodeStatusHistory,
+    NodeTable,
+    OpenSSHControlClient,
+    OutputFormatHelpers,
+    PassiveCheckHelpers,
+    PhaseTimer,
+    RateLimitedClient,
+    ShellSessionClient,
+    SSHHelper,
+    StateFile,
+    TrackedClient
+)
 
 #DEFAULT LIMITS
 #--------------
 DEFAULT_WARNING = 2
 DEFAULT_CRITICAL = 3
 
+#number of nodes mongodb and mco disagree on named in the output
+DISAGREEING_NODES_SHOWN = 10
+
+#number of flapping or down nodes named in the output
+HISTORY_NODES_SHOWN = 10
+
+#samples of a node needed before it can be seen flapping
+FLAP_MIN_SAMPLES = 5
+
+#Server fields needed to check a district
+DISTRICT_SERVER_FIELDS = ('name', 'active', 'unresponsive')
+
 
 def is_node_mco_ping(
     client,
     node_identitiy,
-    debug=False
+    debug=False,
+    timeout=None,
+    cache=None
 ):
     """
 
     :param client:
     :param node_identitiy:
+    :param timeout: seconds to wait for the mco answer, the node is reported
+    as not pinging when it expires. By default wait forever
+    :param cache: FileTTLCache of the ping results
     :return:
     """
-    cmd = "oo-mco rpc rpcutil ping -j -I {i}".format(
-        i=node_identitiy
+    if cache is not None:
+        cached_ping = cache.get(node_identitiy)
+        if cached_ping is not None:
+            return cached_mco_ping(cached_ping)[0]
+
+    mco_ping = node_mco_ping(client, node_identitiy, debug, timeout)
+    if mco_ping is None:
+        # the ping could not start
+        return False
+    if cache is not None:
+        cache.set(node_identitiy, mco_ping)
+    return mco_ping[0]
+
+
+def node_mco_ping(
+    client,
+    node_identitiy,
+    debug=False,
+    timeout=None,
+    deadline=None
+):
+    """
+    Ping one node and measure the time its mco answer took
+
+    :param client:
+    :param node_identitiy:
+    :param timeout: seconds to wait for the mco answer, the node is reported
+    as not pinging when it expires. By default wait forever
+    :param deadline: Deadline bounding the timeout
+    :return: (True/False, round trip time in milliseconds or None), None
+    when the deadline expired before the node could be checked
+    """
+    if deadline is not None:
+        if deadline.expired():
+            return None
+        timeout = deadline.timeout(timeout)
+
+    try:
+        replies = list(
+            mco_ping_replies(
+                client,
+                [node_identitiy],
+                debug,
+                timeout
+            )
+        )
+    except BrokerQueueTimeout:
+        if debug:
+            print("mco ping of {i} did not leave the broker queue".format(i=node_identitiy))
+        # the ping never started, the node is not known to be down
+        return None
+    except socket.timeout:
+        if debug:
+            print("mco ping of {i} timed out".format(i=node_identitiy))
+        if deadline is not None and deadline.expired():
+            # the deadline cut the wait short, the node is not known to be down
+            return None
+        return False, None
+
+    if len(replies) == 1:
+        mco_ping_status, rtt = replies[0]
+        if mco_ping_status:
+            if mco_ping_status['statusmsg'] == 'OK':
+                return True, rtt
+    return False, None
+
+
+def cached_mco_ping(
+    cached_ping
+):
+    """
+    :param cached_ping: cached [True/False, rtt] value, or a bare True/False
+    :return: (True/False, round trip time in milliseconds or None)
+    """
+    if isinstance(cached_ping, bool):
+        return cached_ping, None
+    return cached_ping[0], cached_ping[1]
+
+
+def iter_mco_json_replies(
+    lines
+):
+    """
+    Incrementally parse the JSON array printed by mco, yielding each node
+    reply as soon as its JSON object is complete
+
+    :param lines: iterable of output chunks, e.g. a channel stdout
+    :return: generator of reply dict
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+
+    for line in lines:
+        buf += line
+        if not started:
+            buf = buf.lstrip()
+            if not buf:
+                continue
+            if buf[0] != '[':
+                raise ValueError("mco output is not a JSON array")
+            buf = buf[1:]
+            started = True
+        # a reply can only end on a closing brace or bracket
+        if '}' not in line and ']' not in line:
+            continue
+
+        while True:
+            buf = buf.lstrip().lstrip(',').lstrip()
+            if not buf:
+                break
+            if buf[0] == ']':
+                return
+            try:
+                reply, end = decoder.raw_decode(buf)
+            except ValueError:
+                # incomplete reply, wait for more output
+                break
+            buf = buf[end:]
+            yield reply
+
+    raise ValueError("mco output ended before the end of the JSON array")
+
+
+def mco_ping_replies(
+    client,
+    node_identities,
+    debug=False,
+    timeout=None
+):
+    """
+    Run one mco rpc ping of node_identities without pty and yield the nodes
+    replies while mco prints them
+
+    :param client:
+    :param node_identities: list of node identities to ping
+    :param timeout: seconds to wait for more output, socket.timeout is
+    raised when it expires
+    :return: generator of (reply dict, milliseconds since the mco call)
+    """
+    cmd = "oo-mco rpc rpcutil ping -j {f}".format(
+        f=' '.join(
+            '-I {i}'.format(i=shlex.quote(identity)) for identity in node_identities
+        )
     )
 
     if debug:
         print("Command to execute")
         print(cmd)
 
+    start = time.time()
     stdin, stdout, stderr = client.exec_command(
         cmd,
-        get_pty=True
+        timeout=timeout
     )
-    lines = [line for line in stdout]
-    json_raw = ''.join(lines)
-    json_array = json.loads(json_raw)
+    #the clients queuing the commands tell when this one actually started
+    start = getattr(stdout, 'start_time', start)
 
-    if debug:
-        print("JSON mco ping output")
-        pprint(json_array)
+    for reply in iter_mco_json_replies(stdout):
+        rtt = int(round((time.time() - start) * 1000))
+        if debug:
+            print("JSON mco ping reply after {t}ms".format(t=rtt))
+            pprint(reply)
+        yield reply, rtt
 
-    if len(json_array) == 1:
-        mco_ping_status = json.loads(json_raw)[0]
-        if mco_ping_status:
-            if mco_ping_status['statusmsg'] == 'OK':
-                return True
-    return False
+
+def nodes_mco_batch_ping(
+    client,
+    node_identities,
+    debug=False,
+    timeout=None,
+    deadline=None
+):
+    """
+    Ping a list of nodes with a single mco rpc call. Nodes that never
+    answered are reported as not pinging. mco prints the whole JSON array
+    once the call is over, so the nodes of a batch all seem to answer at
+    the same time and no round trip time is reported for them.
+
+    :param client:
+    :param node_identities: list of node identities to ping
+    :param timeout: seconds to wait for the next answer, the nodes that did
+    not answer yet are reported as not pinging when it expires
+    :param deadline: Deadline of the call, the nodes that did not answer
+    before it expired are left out of the result
+    :return: dict of node identity -> (True/False, None)
+    """
+    node_identities = list(node_identities)
+    if not node_identities or (deadline is not None and deadline.expired()):
+        return {}
+
+    if deadline is not None:
+        timeout = deadline.timeout(timeout)
+
+    answers = {}
+    try:
+        for reply, _ in mco_ping_replies(client, node_identities, debug, timeout):
+            if reply and 'sender' in reply:
+                answers[reply['sender']] = (reply['statusmsg'] == 'OK', None)
+            if deadline is not None and deadline.expired():
+                break
+    except BrokerQueueTimeout:
+        if debug:
+            print("mco batch ping did not leave the broker queue")
+        # the ping never started, the nodes are not known to be down
+        return {}
+    except socket.timeout:
+        if debug:
+            print("mco batch ping timed out after {nb} answers".format(nb=len(answers)))
+
+    if deadline is not None and deadline.expired():
+        return answers
+
+    return {
+        identity: answers.get(identity, (False, None))
+        for identity in node_identities
+    }
+
+
+def nodes_mco_parallel_ping(
+    client,
+    node_identities,
+    workers,
+    debug=False,
+    timeout=None,
+    deadline=None,
+    stop_after=None
+):
+    """
+    Ping nodes one by one, running up to workers mco calls at the same time
+    over their own channel of the client ssh transport.
+
+    :param client:
+    :param node_identities: list of node identities to ping
+    :param workers: maximum number of concurrent mco calls
+    :param timeout: per node mco answer timeout in seconds
+    :param deadline: Deadline of the pings, the nodes not checked before it
+    expired are left out of the result
+    :param stop_after: cancel the outstanding pings once this number of
+    nodes did not answer
+    :return: dict of node identity -> (True/False, round trip time in
+    milliseconds or None)
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+    deadline = deadline or Deadline()
+    #the pings still running once the verdict is reached are closed
+    client = TrackedClient(client)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {
+        executor.submit(
+            node_mco_ping,
+            client,
+            identity,
+            debug,
+            timeout,
+            deadline
+        ): identity for identity in node_identities
+    }
+
+    servers_ping = {}
+    try:
+        for future in as_completed(futures, timeout=deadline.remaining()):
+            ping = future.result()
+            if ping is None:
+                continue
+            servers_ping[futures[future]] = ping
+            if verdict_reached(servers_ping, stop_after):
+                break
+    except FuturesTimeoutError:
+        if debug:
+            print("mco pings deadline expired after {nb} answers".format(nb=len(servers_ping)))
+    finally:
+        for future in futures:
+            future.cancel()
+        client.close_channels()
+        executor.shutdown(wait=False)
+
+    return servers_ping
+
+
+def verdict_reached(
+    servers_ping,
+    stop_after
+):
+    """
+    :param servers_ping: dict of node identity -> (True/False, rtt)
+    :param stop_after: number of not answering nodes fixing the verdict, None
+    to never stop
+    :return: True once the remaining pings can not change the verdict
+    """
+    if stop_after is None:
+        return False
+    return sum(1 for ping in servers_ping.values() if not ping[0]) >= stop_after
 
 
 def nodes_mco_ping_status(
         client,
         mongo_district_dict,
-        debug=False
+        debug=False,
+        batch_size=0,
+        workers=1,
+        timeout=None,
+        cache=None,
+        state=None,
+        incremental_slice=10,
+        full_sweep_every=10,
+        deadline=None,
+        stop_after=None
 ):
     """
 
-    :param client:
+    :param client: broker ssh client, or list of clients sharing the nodes
     :param mongo_district_dict:
+    :param batch_size: if > 0, ping nodes by batches of batch_size identities
+    per mco rpc call instead of one call per node
+    :param workers: number of concurrent per node mco calls
+    :param timeout: per node mco answer timeout in seconds
+    :param cache: FileTTLCache of the ping results, only the nodes without a
+    fresh result are pinged
+    :param state: StateFile of the last known nodes status, only the suspect
+    nodes and a slice of the healthy ones are pinged, see incremental_ping_plan
+    :param incremental_slice: number of healthy nodes pinged on each run
+    :param full_sweep_every: ping all the nodes every full_sweep_every runs
+    :param deadline: Deadline of the pings, the nodes not checked before it
+    expired are left out of the result
+    :param stop_after: stop pinging once this number of nodes did not answer
     :return:
     """
-    servers_ping = {
-        server['name']: is_node_mco_ping(
+    if state is not None:
+        servers = mongo_district_dict['servers']
+        to_ping = incremental_ping_plan(
+            state.load().get(mongo_district_dict['name'], {}),
+            servers,
+            incremental_slice,
+            full_sweep_every
+        )
+        pinged_status = nodes_mco_ping_status(
             client,
-            server['name'],
-            debug
+            {'servers': [server for server in servers if server['name'] in to_ping]},
+            debug,
+            batch_size=batch_size,
+            workers=workers,
+            timeout=timeout,
+            cache=cache,
+            deadline=deadline,
+            stop_after=stop_after
         )
-        for server in mongo_district_dict['servers']
-    }
+        with state.locked() as nodes_state:
+            return incremental_merge(
+                nodes_state.setdefault(mongo_district_dict['name'], {}),
+                servers,
+                pinged_status,
+                incremental_slice
+            )
+
+    if isinstance(client, list):
+        return nodes_mco_sharded_ping_status(
+            client,
+            mongo_district_dict,
+            debug,
+            batch_size=batch_size,
+            workers=workers,
+            timeout=timeout,
+            cache=cache,
+            deadline=deadline,
+            stop_after=stop_after
+        )
+
+    servers_name = [server['name'] for server in mongo_district_dict['servers']]
+
+    cached_ping = {}
+    if cache is not None:
+        cached_ping = {
+            name: cached_mco_ping(ping)
+            for name, ping in cache.get_many(servers_name).items()
+        }
+        servers_name = [name for name in servers_name if name not in cached_ping]
+
+    if stop_after is not None:
+        stop_after = max(stop_after - sum(1 for ping in cached_ping.values() if not ping[0]), 0)
+
+    servers_ping = {}
+    if batch_size > 0:
+        for i in range(0, len(servers_name), batch_size):
+            if verdict_reached(servers_ping, stop_after):
+                break
+            servers_ping.update(
+                nodes_mco_batch_ping(
+                    client,
+                    servers_name[i:i + batch_size],
+                    debug,
+                    timeout,
+                    deadline
+                )
+            )
+    elif workers > 1:
+        servers_ping = nodes_mco_parallel_ping(
+            client,
+            servers_name,
+            workers,
+            debug,
+            timeout,
+            deadline,
+            stop_after
+        )
+    else:
+        for server_name in servers_name:
+            if verdict_reached(servers_ping, stop_after):
+                break
+            ping = node_mco_ping(
+                client,
+                server_name,
+                debug,
+                timeout,
+                deadline
+            )
+            if ping is None:
+                if deadline is not None and deadline.expired():
+                    break
+                #the ping did not leave the broker queue, try the next node
+                continue
+            servers_ping[server_name] = ping
+
+    if cache is not None:
+        cache.set_many(servers_ping)
+        servers_ping.update(cached_ping)
+
+    return mco_servers_status(servers_ping)
+
+
+def nodes_mco_sharded_ping_status(
+        clients,
+        mongo_district_dict,
+        debug=False,
+        **mco_ping_options
+):
+    """
+    Split the district nodes between the brokers, each broker pings its
+    share at the same time as the others
+
+    :param clients: list of broker ssh clients
+    :param mongo_district_dict:
+    :param mco_ping_options: extra nodes_mco_ping_status arguments
+    :return: same as nodes_mco_ping_status
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    servers = mongo_district_dict['servers']
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        shares = [
+            executor.submit(
+                nodes_mco_ping_status,
+                client,
+                {'servers': servers[i::len(clients)]},
+                debug,
+                **mco_ping_options
+            ) for i, client in enumerate(clients)
+        ]
+        servers_status = {}
+        for share in shares:
+            servers_status.update(share.result())
+    return servers_status
+
+
+def incremental_ping_plan(
+        district_state,
+        servers,
+        slice_size,
+        full_sweep_every
+):
+    """
+    Choose the nodes to ping on this run : the new nodes, the nodes that did
+    not answer the last ping, the nodes whose mongodb flags changed and a
+    rotating slice of the healthy nodes. Every full_sweep_every runs all the
+    nodes are pinged.
+
+    :param district_state: district state saved by incremental_merge
+    :param servers: district servers
+    :param slice_size: number of healthy nodes pinged on each run
+    :param full_sweep_every: ping all the nodes every full_sweep_every runs
+    :return: set of node names to ping
+    """
+    run = district_state.get('run', 0)
+    if full_sweep_every <= 1 or run % full_sweep_every == 0:
+        return set(server['name'] for server in servers)
+
+    known_nodes = district_state.get('nodes', {})
+    to_ping = set()
+    healthy = []
+    for server in servers:
+        node = known_nodes.get(server['name'])
+        if (
+            node is None or
+            not node['mco_active'] or
+            any(
+                field in server and server[field] != node.get(field)
+                for field in ('active', 'unresponsive')
+            )
+        ):
+            to_ping.add(server['name'])
+        else:
+            healthy.append(server['name'])
+
+    if healthy and slice_size > 0:
+        healthy.sort()
+        cursor = district_state.get('cursor', 0) % len(healthy)
+        to_ping.update((healthy + healthy)[cursor:cursor + min(slice_size, len(healthy))])
+
+    return to_ping
+
+
+def incremental_merge(
+        district_state,
+        servers,
+        pinged_status,
+        slice_size
+):
+    """
+    Complete the status of the pinged nodes with the last known status of
+    the others, and update district_state for the next run
+
+    :param district_state: district state, updated in place
+    :param servers: district servers
+    :param pinged_status: mco servers status of the pinged nodes
+    :param slice_size: number of healthy nodes pinged on each run
+    :return: mco servers status of the district nodes, with a pinged flag
+    """
+    known_nodes = district_state.get('nodes', {})
+    servers_status = {}
+    nodes = {}
+    for server in servers:
+        name = server['name']
+        if name in pinged_status:
+            status = dict(pinged_status[name], pinged=True)
+        elif name not in known_nodes:
+            # new node the deadline left unchecked
+            continue
+        else:
+            mco_active = known_nodes[name]['mco_active']
+            status = {
+                'active': mco_active,
+                'unresponsive': not mco_active,
+                'rtt': None,
+                'pinged': False
+            }
+        servers_status[name] = status
+        nodes[name] = {
+            'mco_active': status['active'],
+            'active': server.get('active'),
+            'unresponsive': server.get('unresponsive')
+        }
 
+    district_state['nodes'] = nodes
+    district_state['run'] = district_state.get('run', 0) + 1
+    district_state['cursor'] = district_state.get('cursor', 0) + slice_size
+    return servers_status
+
+
+def mco_servers_status(
+        servers_ping
+):
+    """
+    Turn mco ping answers into servers status
+
+    :param servers_ping: dict of node identity -> (True/False, round trip
+    time in milliseconds or None)
+    :return: dict of node identity -> active/unresponsive status and rtt
+    """
     servers_status = {
         server_name: {
             'unresponsive': not mco_ping,
-            'active': mco_ping
-        } for server_name, mco_ping in servers_ping.items()
+            'active': mco_ping,
+            'rtt': rtt
+        } for server_name, (mco_ping, rtt) in servers_ping.items()
     }
 
     return servers_status
 
+def districts_projection(
+        server_fields=DISTRICT_SERVER_FIELDS
+):
+    """
+    Projection returning only the needed fields of the district servers
+
+    :param server_fields: servers sub document fields to return
+    :return: projection dict
+    """
+    projection = {
+        'servers.{f}'.format(f=field): 1 for field in server_fields
+    }
+    projection['name'] = 1
+    return projection
+
+
 def openshift_district(
         mongodb_db_connection,
         district_name,
-        debug=False
+        debug=False,
+        server_fields=DISTRICT_SERVER_FIELDS,
+        watcher=None
 ):
     """
 
     :param mongodb_db_connection:
     :param district_name:
+    :param server_fields: servers sub document fields to return
+    :param watcher: MongoDBCollectionWatcher of the districts, the district
+    is then read from memory
     :return:
     """
+    if watcher is not None:
+        for district in watcher.get_documents():
+            if district['name'] == district_name:
+                return district
+        return None
+
     collection = mongodb_db_connection['districts']
 
     if debug:
@@ -151,9 +747,7 @@ def openshift_district(
         {
             'name': district_name
         },
-        {
-            'servers': 1
-        }
+        districts_projection(server_fields)
     )
 
     if debug:
@@ -163,6 +757,218 @@ def openshift_district(
     return district
 
 
+def openshift_districts(
+        mongodb_db_connection,
+        district_names=None,
+        district_pattern=None,
+        debug=False,
+        server_fields=DISTRICT_SERVER_FIELDS,
+        watcher=None
+):
+    """
+    Load several districts with one query. Without names nor pattern all the
+    districts are loaded.
+
+    :param mongodb_db_connection:
+    :param district_names: list of district names
+    :param district_pattern: regular expression the district names must match
+    :param server_fields: servers sub document fields to return
+    :param watcher: MongoDBCollectionWatcher of the districts, the districts
+    are then read from memory
+    :return: list of district dict sorted by name
+    """
+    if watcher is not None:
+        return sorted(
+            [
+                district for district in watcher.get_documents()
+                if (
+                    (not district_names or district['name'] in district_names) and
+                    (district_names or not district_pattern or re.search(district_pattern, district['name']))
+                )
+            ],
+            key=lambda district: district['name']
+        )
+
+    collection = mongodb_db_connection['districts']
+
+    query = MongoDBHelper.districts_query(district_names, district_pattern)
+
+    if debug:
+        print("The districts query")
+        pprint(query)
+
+    districts = list(
+        collection.find(
+            query,
+            districts_projection(server_fields)
+        ).sort('name', 1)
+    )
+
+    if debug:
+        print('The districts')
+        pprint(districts)
+
+    return districts
+
+
+def districts_servers_counts(
+        mongodb_db_connection,
+        district_names=None,
+        district_pattern=None,
+        debug=False
+):
+    """
+    Count the active and unresponsive servers of the districts inside
+    mongodb with an aggregation pipeline, which also returns the names of
+    the few servers not active or unresponsive
+
+    :param mongodb_db_connection:
+    :param district_names: list of district names
+    :param district_pattern: regular expression the district names must match
+    :return: dict of district name -> {'active': nb, 'unresponsive': nb,
+    'inactive_names': [name], 'unresponsive_names': [name]}
+    """
+    collection = mongodb_db_connection['districts']
+
+    pipeline = [
+        {
+            '$match': MongoDBHelper.districts_query(district_names, district_pattern)
+        },
+        {
+            '$project': {
+                'name': 1,
+                'servers.name': 1,
+                'servers.active': 1,
+                'servers.unresponsive': 1
+            }
+        },
+        {
+            '$unwind': '$servers'
+        },
+        {
+            '$group': {
+                '_id': '$name',
+                'active': {
+                    '$sum': {'$cond': ['$servers.active', 1, 0]}
+                },
+                'unresponsive': {
+                    '$sum': {'$cond': ['$servers.unresponsive', 1, 0]}
+                },
+                'inactive_names': {
+                    '$push': {'$cond': ['$servers.active', None, '$servers.name']}
+                },
+                'unresponsive_names': {
+                    '$push': {'$cond': ['$servers.unresponsive', '$servers.name', None]}
+                }
+            }
+        },
+        {
+            #$cond pushed a null for each server not to name
+            '$project': {
+                'active': 1,
+                'unresponsive': 1,
+                'inactive_names': {'$setDifference': ['$inactive_names', [None]]},
+                'unresponsive_names': {'$setDifference': ['$unresponsive_names', [None]]}
+            }
+        }
+    ]
+
+    if debug:
+        print("The districts servers count pipeline")
+        pprint(pipeline)
+
+    counts = {
+        group['_id']: {
+            'active': group['active'],
+            'unresponsive': group['unresponsive'],
+            'inactive_names': group['inactive_names'],
+            'unresponsive_names': group['unresponsive_names']
+        } for group in collection.aggregate(pipeline)
+    }
+
+    if debug:
+        print("The districts servers count")
+        pprint(counts)
+
+    return counts
+
+
+def load_districts(
+        mongodb_db_connection,
+        district_names=None,
+        district_pattern=None,
+        all_districts=False,
+        aggregate=False,
+        debug=False,
+        watcher=None
+):
+    """
+    Load the districts to check, a single district name is loaded with
+    find_one, anything else with openshift_districts
+
+    :param mongodb_db_connection:
+    :param district_names: list of district names
+    :param district_pattern: regular expression the district names must match
+    :param all_districts: load all the districts
+    :param aggregate: count the servers status inside mongodb, the districts
+    are then loaded with their server names only and a servers_counts entry
+    naming the servers not active or unresponsive
+    :param watcher: MongoDBCollectionWatcher of the districts, the districts
+    are then read from memory and never aggregated
+    :return: list of district dict with their name
+    """
+    if watcher is not None:
+        aggregate = False
+
+    server_fields = ('name',) if aggregate else DISTRICT_SERVER_FIELDS
+
+    if all_districts or district_pattern is not None or len(district_names) > 1:
+        if all_districts:
+            district_names = None
+        districts = openshift_districts(
+            mongodb_db_connection=mongodb_db_connection,
+            district_names=district_names,
+            district_pattern=district_pattern,
+            debug=debug,
+            server_fields=server_fields,
+            watcher=watcher
+        )
+        if not districts:
+            raise Exception("No openshift district found")
+
+        missing = set(district_names or []) - set(district['name'] for district in districts)
+        if missing:
+            raise Exception("Unknown openshift district {d}".format(d=', '.join(sorted(missing))))
+    else:
+        district_name = district_names[0]
+        district = openshift_district(
+            mongodb_db_connection=mongodb_db_connection,
+            district_name=district_name,
+            debug=debug,
+            server_fields=server_fields,
+            watcher=watcher
+        )
+        if district is None:
+            raise Exception("Unknown openshift district {d}".format(d=district_name))
+        district['name'] = district_name
+        districts = [district]
+
+    if aggregate:
+        counts = districts_servers_counts(
+            mongodb_db_connection,
+            district_names=district_names,
+            district_pattern=district_pattern,
+            debug=debug
+        )
+        for district in districts:
+            district['servers_counts'] = counts.get(
+                district['name'],
+                {'active': 0, 'unresponsive': 0, 'inactive_names': [], 'unresponsive_names': []}
+            )
+
+    return districts
+
+
 def servers_status(
         mongo_district_dict
 ):
@@ -207,129 +1013,1409 @@ def nb_active_servers(
             ]
     )
 
-# OPT parsing
-# -----------
-parser = optparse.OptionParser(
-    "%prog [options]", version="%prog " + version)
+def percentile(
+        sorted_values,
+        percent
+):
+    """
+    Nearest rank percentile
 
-#broker ssh param
-parser.add_option('--broker-hostname', default='',
-                  dest="broker_hostname", help='Broker to connect to')
-parser.add_option('--broker-ssh-port',
-                  dest="broker_ssh_port", type="int", default=22,
-                  help='SSH port to connect to the broker. Default : 22')
-parser.add_option('--broker-ssh-key', default=os.path.expanduser('~/.ssh/id_rsa'),
-                  dest="broker_ssh_key_file", help='SSH key file to use. By default will take ~/.ssh/id_rsa.')
-parser.add_option('--broker-ssh-user', default='shinken',
-                  dest="broker_ssh_user", help='remote use to use. By default shinken.')
-parser.add_option('--broker-passphrase', default='',
-                  dest="broker_ssh_passphrase", help='SSH key passphrase. By default will use void')
+    :param sorted_values: non empty sorted list
+    :param percent: percentile in [0, 100]
+    :return: value
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank - 1, 0)]
 
-#mongodb connection
-parser.add_option('--mongo-hostname',
-                  dest="mongo_hostnames",
-                  help='space separated mongodb hostnames:port list to connect to. '
-                       'Example :  "server1:27017 server2:27017" ')
-parser.add_option('--mongo-user',
-                  dest="mongo_user", default="shinken",
-                  help='remote use to use. By default shinken.')
-parser.add_option('--mongo-password',
-                  dest="mongo_password",
-                  help='Password. By default will use void')
-parser.add_option('--mongo-source-longon',
-                  dest="mongo_source", default='admin',
-                  help='Source where to log on. Default: admin')
-parser.add_option('--mongo-replicaset',
-                  dest="mongo_replicaset",
-                  help='openshift current mongodb replicaset')
-parser.add_option('--mongo-openshift-database-name',
-                  dest="mongo_openshift_database",
-                  help='openshift current database')
 
-#openshift relative
-parser.add_option('--openshift-district-name',
-                  dest="openshift_district",
-                  help='openshift district to query')
-parser.add_option('-w', '--warning',
-                  dest="warning", type="int",default=None,
-                  help='Warning value for number of unresponsive nodes. Default : 2')
-parser.add_option('-c', '--critical',
-                  dest="critical", type="int",default=None,
-                  help='Critical value for number of unresponsive nodes. Default : 3')
+def mco_rtt_stats(
+        servers_status_dict
+):
+    """
 
-#generic
-parser.add_option('--debug',
-                  dest="debug", default=False, action="store_true",
-                  help='Enable debug')
+    :param servers_status_dict: mco servers status with their rtt
+    :return: dict with the min, p50, p95 and max round trip times in
+    milliseconds, empty when no node answered
+    """
+    rtts = sorted(
+        status['rtt'] for status in servers_status_dict.values()
+        if status.get('rtt') is not None
+    )
+    if not rtts:
+        return {}
+    return {
+        'min': rtts[0],
+        'p50': percentile(rtts, 50),
+        'p95': percentile(rtts, 95),
+        'max': rtts[-1]
+    }
 
-if __name__ == '__main__':
 
-    # Ok first job : parse args
-    opts, args = parser.parse_args()
-    if args:
-        parser.error("Does not accept any argument.")
+def slowest_mco_nodes(
+        servers_status_dict,
+        nb
+):
+    """
 
-    #Broker ssh args
-    #---------------
+    :param servers_status_dict: mco servers status with their rtt
+    :param nb: number of nodes to return
+    :return: list of (node name, rtt) of the nb slowest answering nodes
+    """
+    if nb <= 0:
+        return []
+    answered = [
+        (name, status['rtt']) for name, status in servers_status_dict.items()
+        if status.get('rtt') is not None
+    ]
+    return heapq.nlargest(nb, answered, key=lambda node: node[1])
+
+
+def district_check(
+        client,
+        district,
+        district_name,
+        warning,
+        critical,
+        debug=False,
+        mco_servers_status=None,
+        timer=None,
+        slowest=0,
+        deadline=None,
+        **mco_ping_options
+):
+    """
+    Check one district, comparing the mongodb nodes status with the mco ping
+    answers
+
+    :param client: broker ssh client
+    :param district: district dict from mongodb, the server names of its
+    servers_counts entry are used instead of the servers flags when present
+    :param district_name: name used in the message and perf data labels
+    :param warning: warning number of unresponsive nodes
+    :param critical: critical number of unresponsive nodes
+    :param mco_servers_status: already known mco servers status, the nodes
+    are pinged when None
+    :param timer: PhaseTimer timing the mco pings
+    :param slowest: number of slowest nodes to name in the message
+    :param deadline: Deadline of the mco pings, the pings also stop once
+    critical nodes did not answer. The nodes left unchecked are reported
+    :param mco_ping_options: extra nodes_mco_ping_status arguments
+    :return: dict with the district name, status, message, perf data list,
+    metrics and the NodeTable of its nodes
+    """
+    #one bit per node and status flag
+    nodes = NodeTable(server['name'] for server in district['servers'])
+
+    #get unresponsive/active count from the db
+    #-----------------------------------------
+    if 'servers_counts' in district:
+        #mongodb only returned the names of the servers not active or unresponsive
+        servers_counts = district['servers_counts']
+        if debug:
+            print("mongodb servers counts")
+            pprint(servers_counts)
+
+        inactive = set(servers_counts['inactive_names'])
+        db_active = nodes.set(
+            'db_active',
+            (name for name in nodes.names if name not in inactive)
+        )
+        db_unresponsive = nodes.set('db_unresponsive', servers_counts['unresponsive_names'])
+    else:
+        if debug:
+            print("mongodb servers status")
+            pprint(servers_status(district))
+
+        db_active = nodes.set(
+            'db_active',
+            (server['name'] for server in district['servers'] if server['active'])
+        )
+        db_unresponsive = nodes.set(
+            'db_unresponsive',
+            (server['name'] for server in district['servers'] if server['unresponsive'])
+        )
+    db_nb_unresponsive_servers = nodes.count(db_unresponsive)
+    db_nb_active_servers = nodes.count(db_active)
+
+    #get mco ping responce
+    #---------------------
+    ssh_mco_servers_status = mco_servers_status
+    if ssh_mco_servers_status is None:
+        with (timer or PhaseTimer()).phase('mco_ping'):
+            ssh_mco_servers_status = nodes_mco_ping_status(
+                client,
+                district,
+                debug,
+                deadline=deadline,
+                stop_after=critical if deadline is not None else None,
+                **mco_ping_options
+            )
+    if debug:
+        print("mco servers status")
+        pprint(ssh_mco_servers_status)
+
+    #get unresponsive/active count from remote mco ping
+    mco_checked = nodes.set('mco_checked', ssh_mco_servers_status)
+    mco_active = nodes.set(
+        'mco_active',
+        (name for name, status in ssh_mco_servers_status.items() if status['active'])
+    )
+    mco_unresponsive = mco_checked & ~mco_active
+    nb_mco_ping_active_servers = nodes.count(mco_active)
+    nb_mco_ping_unresponsive_servers = nodes.count(mco_unresponsive)
+
+    #format perf data
+    db_active_servers_data_string = OutputFormatHelpers.perf_data_string(
+        label="{d}_mongodb_active_nodes".format(d=district_name),
+        value=db_nb_active_servers,
+    )
+    db_unresponsive_servers_data_string = OutputFormatHelpers.perf_data_string(
+        label="{d}_mongodb_unresponsive_servers".format(d=district_name),
+        value=db_nb_unresponsive_servers,
+        warn=warning,
+        crit=critical
+    )
+    mco_active_servers_data_string = OutputFormatHelpers.perf_data_string(
+        label="{d}_mco_active_nodes".format(d=district_name),
+        value=nb_mco_ping_active_servers,
+    )
+    mco_unresponsive_servers_data_string = OutputFormatHelpers.perf_data_string(
+        label="{d}_mco_unresponsive_servers".format(d=district_name),
+        value=nb_mco_ping_unresponsive_servers,
+        warn=warning,
+        crit=critical
+    )
+
+    #incremental runs only ping part of the nodes
+    pinged_perfdata = []
+    if any('pinged' in status for status in ssh_mco_servers_status.values()):
+        pinged_perfdata.append(
+            OutputFormatHelpers.perf_data_string(
+                label="{d}_mco_pinged_nodes".format(d=district_name),
+                value=sum(status['pinged'] for status in ssh_mco_servers_status.values()),
+                min=0,
+                max=len(ssh_mco_servers_status)
+            )
+        )
+
+    #nodes the deadline, an already critical verdict, the broker queue or a
+    #busy broker shell left unchecked
+    nb_unchecked_servers = len(nodes) - nodes.count(mco_checked)
+    unchecked_perfdata = []
+    if deadline is not None or nb_unchecked_servers:
+        unchecked_perfdata.append(
+            OutputFormatHelpers.perf_data_string(
+                label="{d}_mco_unchecked_nodes".format(d=district_name),
+                value=nb_unchecked_servers,
+                min=0,
+                max=len(district['servers'])
+            )
+        )
+
+    #mco round trip times
+    rtt_stats = mco_rtt_stats(ssh_mco_servers_status)
+    rtt_perfdata = [
+        OutputFormatHelpers.perf_data_string(
+            label="{d}_mco_rtt_{s}".format(d=district_name, s=stat),
+            value=rtt_stats[stat],
+            UOM='ms',
+            min=0
+        ) for stat in ('min', 'p50', 'p95', 'max') if stat in rtt_stats
+    ]
+
+    #check
+    #a node is down when either view says so
+    unresponsive = db_unresponsive | mco_unresponsive
+    nb_unresponsive = nodes.count(unresponsive)
+    nb_active = nodes.count((db_active | mco_active) & ~unresponsive)
+
+    mco_only_unresponsive = mco_unresponsive & ~db_unresponsive
+    db_only_unresponsive = db_unresponsive & mco_active
+    disagreeing_perfdata = [
+        OutputFormatHelpers.perf_data_string(
+            label="{d}_disagreeing_nodes".format(d=district_name),
+            value=nodes.count(mco_only_unresponsive | db_only_unresponsive),
+            min=0,
+            max=len(nodes)
+        )
+    ]
+
+    status = "OK"
+    state = "active"
+    nb = nb_active
+    if nb_unresponsive >= warning:
+        status = "Warning"
+        state = "unresponsive"
+        nb = nb_unresponsive
+    if nb_unresponsive >= critical:
+        status = "Critical"
+        state = "unresponsive"
+        nb = nb_unresponsive
+
+    message = "{nb} {state} openshift nodes".format(
+        nb=nb,
+        state=state
+    )
+    if nb_unchecked_servers:
+        message += ", {nb} nodes not checked".format(nb=nb_unchecked_servers)
+    disagreeing_nodes = (
+        ["{n} (mco down)".format(n=name) for name in nodes.names_of(mco_only_unresponsive)] +
+        ["{n} (mongodb down)".format(n=name) for name in nodes.names_of(db_only_unresponsive)]
+    )
+    if disagreeing_nodes:
+        message += ", mongodb and mco disagree on {nb} nodes: {n}".format(
+            nb=len(disagreeing_nodes),
+            n=', '.join(disagreeing_nodes[:DISAGREEING_NODES_SHOWN])
+        )
+        if len(disagreeing_nodes) > DISAGREEING_NODES_SHOWN:
+            message += ', ...'
+
+    slowest_nodes = slowest_mco_nodes(ssh_mco_servers_status, slowest)
+    if slowest_nodes:
+        message += ", slowest mco nodes: {n}".format(
+            n=', '.join(
+                "{name} ({rtt}ms)".format(name=name, rtt=rtt) for name, rtt in slowest_nodes
+            )
+        )
+
+    metrics = {
+        'mongodb_active_nodes': db_nb_active_servers,
+        'mongodb_unresponsive_nodes': db_nb_unresponsive_servers,
+        'mco_active_nodes': nb_mco_ping_active_servers,
+        'mco_unresponsive_nodes': nb_mco_ping_unresponsive_servers,
+        'mco_unchecked_nodes': nb_unchecked_servers,
+        'disagreeing_nodes': len(disagreeing_nodes)
+    }
+    metrics.update(
+        ('mco_rtt_{s}_milliseconds'.format(s=stat), value) for stat, value in rtt_stats.items()
+    )
+
+    return {
+        'name': district_name,
+        'status': status,
+        'message': message,
+        'perfdata': [
+            db_active_servers_data_string,
+            db_unresponsive_servers_data_string,
+            mco_active_servers_data_string,
+            mco_unresponsive_servers_data_string
+        ] + pinged_perfdata + unchecked_perfdata + disagreeing_perfdata + rtt_perfdata,
+        'metrics': metrics,
+        'nodes': nodes
+    }
+
+
+def node_check_results(
+        district_result,
+        node_service,
+        host_checks=False
+):
+    """
+    Per node passive check results of a checked district : a node is
+    Critical when mongodb or mco report it unresponsive, Unknown when it was
+    not pinged
+
+    :param district_result: district_check result
+    :param node_service: service description of the nodes service
+    :param host_checks: also submit a host result per pinged node, UP when
+    it answered the mco ping
+    :return: list of check result dict
+    """
+    nodes = district_result['nodes']
+    all_nodes = (1 << len(nodes)) - 1
+    mco_checked = nodes.get('mco_checked')
+    mco_unresponsive = set(nodes.names_of(mco_checked & ~nodes.get('mco_active')))
+    db_unresponsive = set(nodes.names_of(nodes.get('db_unresponsive')))
+    unchecked = set(nodes.names_of(all_nodes & ~mco_checked))
+
+    results = []
+    for name in nodes.names:
+        problems = []
+        if name in mco_unresponsive:
+            problems.append("mco ping failed")
+        if name in db_unresponsive:
+            problems.append("unresponsive in mongodb")
+
+        if problems:
+            state, message = "Critical", ', '.join(problems)
+        elif name in unchecked:
+            state, message = "Unknown", "mco ping not checked"
+        else:
+            state, message = "OK", "mco ping OK"
+        results.append({
+            'host_name': name,
+            'service_description': node_service,
+            'return_code': OutputFormatHelpers.exit_code(state),
+            'output': "{s}: {m}".format(s=state, m=message)
+        })
+
+        if host_checks and name not in unchecked:
+            results.append({
+                'host_name': name,
+                'return_code': 1 if name in mco_unresponsive else 0,
+                'output': "mco ping failed" if name in mco_unresponsive else "mco ping OK"
+            })
+
+    return results
+
+
+def nodes_active_status(
+        district_result
+):
+    """
+    :param district_result: district_check result
+    :return: dict of node name -> True when active, False when mongodb or
+    mco report it unresponsive. The nodes left unchecked are skipped
+    """
+    nodes = district_result['nodes']
+    mco_checked = nodes.get('mco_checked')
+    unresponsive = (mco_checked & ~nodes.get('mco_active')) | nodes.get('db_unresponsive')
+    status = dict.fromkeys(nodes.names_of(mco_checked & ~unresponsive), True)
+    status.update(dict.fromkeys(nodes.names_of(unresponsive), False))
+    return status
+
+
+def duration_string(
+        seconds
+):
+    """
+    :return: short human readable duration, e.g. 2d3h, 3h12m, 40s
+    """
+    seconds = int(seconds)
+    for unit, sub_unit, size, sub_size in (('d', 'h', 86400, 3600), ('h', 'm', 3600, 60)):
+        if seconds >= size:
+            return "{n}{u}{s}{su}".format(
+                n=seconds // size,
+                u=unit,
+                s=seconds % size // sub_size,
+                su=sub_unit
+            )
+    if seconds >= 60:
+        return "{n}m".format(n=seconds // 60)
+    return "{n}s".format(n=seconds)
+
+
+def district_history_check(
+        district_result,
+        nodes_history,
+        flap_threshold
+):
+    """
+    Tell the flapping nodes, switching between active and unresponsive,
+    from the nodes that stay down, and add them to a district result
+
+    :param district_result: district_check result, updated in place
+    :param nodes_history: NodeStatusHistory.record summary of the nodes
+    :param flap_threshold: percent of status changes between two samples
+    from which a node is flapping
+    :return: district_result
+    """
+    name = district_result['name']
+    status = nodes_active_status(district_result)
+
+    flapping = []
+    down = []
+    for node in district_result['nodes'].names:
+        history = nodes_history.get(node)
+        if history is None or node not in status:
+            continue
+        if (history['samples'] >= FLAP_MIN_SAMPLES and
+                history['flap_rate'] * 100 >= flap_threshold):
+            flapping.append("{n} ({c} changes in {s} runs)".format(
+                n=node,
+                c=history['changes'],
+                s=history['samples']
+            ))
+        elif not status[node]:
+            down.append((history['since_change'], node))
+    #the longest down first
+    down = [
+        "{n} (for {t})".format(n=node, t=duration_string(since))
+        for since, node in sorted(down, reverse=True)
+    ]
+
+    for label, nodes in (('flapping', flapping), ('down', down)):
+        district_result['perfdata'].append(
+            OutputFormatHelpers.perf_data_string(
+                label="{d}_{l}_nodes".format(d=name, l=label),
+                value=len(nodes),
+                min=0,
+                max=len(district_result['nodes'])
+            )
+        )
+        district_result['metrics']['{l}_nodes'.format(l=label)] = len(nodes)
+        if nodes:
+            district_result['message'] += ", {nb} {l} nodes: {n}".format(
+                nb=len(nodes),
+                l=label,
+                n=', '.join(nodes[:HISTORY_NODES_SHOWN])
+            )
+            if len(nodes) > HISTORY_NODES_SHOWN:
+                district_result['message'] += ', ...'
+    return district_result
+
+
+def districts_history_check(
+        check_districts,
+        history,
+        flap_threshold,
+        **kwargs
+):
+    """
+    Check the districts, record the nodes status in their history and
+    report the flapping and down nodes
+
+    :param check_districts: callable returning the district_check results
+    :param history: NodeStatusHistory
+    :param flap_threshold: see district_history_check
+    :param kwargs: check_districts arguments
+    :return: list of district_check results
+    """
+    results = check_districts(**kwargs)
+
+    status = {}
+    for result in results:
+        status.update(nodes_active_status(result))
+    nodes_history = history.record(status)
+
+    return [
+        district_history_check(result, nodes_history, flap_threshold) for result in results
+    ]
+
+
+def passive_check_results(
+        results,
+        district_host,
+        district_service,
+        node_service,
+        host_checks=False
+):
+    """
+    Turn the districts check results into one passive result per district
+    and per node
+
+    :param results: list of district_check results
+    :param district_host: host name of the districts services
+    :param district_service: service description of a district, formated
+    with its name as district
+    :param node_service: service description of the nodes service
+    :param host_checks: also submit a host result per pinged node
+    :return: list of check result dict
+    """
+    check_results = []
+    for result in results:
+        check_results.append({
+            'host_name': district_host,
+            'service_description': district_service.format(district=result['name']),
+            'return_code': OutputFormatHelpers.exit_code(result['status']),
+            'output': OutputFormatHelpers.check_output_string(
+                result['status'],
+                result['message'],
+                result['perfdata']
+            )
+        })
+        check_results += node_check_results(result, node_service, host_checks)
+    return check_results
+
+
+def districts_prometheus_output(
+        results
+):
+    """
+    Format the districts check results as prometheus metrics
+
+    :param results: list of district_check results
+    :return: prometheus text string
+    """
+    metrics = [
+        OutputFormatHelpers.prometheus_string(
+            'openshift_district_status',
+            [
+                (
+                    {'district': result['name']},
+                    OutputFormatHelpers.exit_code(result['status'])
+                ) for result in results
+            ],
+            help='District check state, 0 OK, 1 Warning, 2 Critical, 3 Unknown'
+        )
+    ]
+    metric_names = sorted(
+        set(name for result in results for name in result.get('metrics', {}))
+    )
+    metrics += [
+        OutputFormatHelpers.prometheus_string(
+            'openshift_district_{n}'.format(n=name),
+            [
+                ({'district': result['name']}, result['metrics'][name])
+                for result in results if name in result.get('metrics', {})
+            ]
+        ) for name in metric_names
+    ]
+    return ''.join(metrics)
+
+
+class DistrictsCollector(object):
+    """
+    Check the districts every interval seconds and keep the formated
+    results in memory, served over http by serve_forever
+    """
+
+    def __init__(
+            self,
+            check_districts,
+            multi_district,
+            interval=60,
+            debug=False
+    ):
+        """
+
+        :param check_districts: callable returning the district_check results
+        :param multi_district: format the nagios output with one line per district
+        :param interval: seconds between two checks
+        """
+        self.check_districts = check_districts
+        self.multi_district = multi_district
+        self.interval = interval
+        self.debug = debug
+        self.timestamp = None
+        self.outputs = {}
+        self.lock = threading.Lock()
+
+    def collect(self):
+        """
+        Run the check once and replace the served outputs
+        """
+        try:
+            results = self.check_districts()
+            status, output = OutputFormatHelpers.districts_check_output(results, self.multi_district)
+            outputs = {
+                '/nagios': (status, output),
+                '/metrics': ('OK', districts_prometheus_output(results))
+            }
+            for result in results:
+                outputs['/nagios/{n}'.format(n=result['name'])] = (
+                    result['status'],
+                    OutputFormatHelpers.check_output_string(
+                        result['status'],
+                        result['message'],
+                        result['perfdata']
+                    )
+                )
+        except Exception as e:
+            if self.debug:
+                traceback.print_exc()
+            outputs = {
+                '/nagios': ('Unknown', "Unknown: collector error: {m}".format(m=e)),
+                '/metrics': ('Unknown', '')
+            }
+
+        with self.lock:
+            self.outputs = outputs
+            self.timestamp = time.time()
+
+    def get(
+            self,
+            path
+    ):
+        """
+        :param path: /nagios, /nagios/<district> or /metrics
+        :return: check state, output string
+        """
+        with self.lock:
+            outputs = self.outputs
+            timestamp = self.timestamp
+
+        if timestamp is None:
+            return 'Unknown', "Unknown: no collected result yet"
+        age = time.time() - timestamp
+        if age > 3 * self.interval:
+            return 'Unknown', "Unknown: collected results are {a:.0f} seconds old".format(a=age)
+        if path not in outputs:
+            return 'Unknown', "Unknown: no collected result for {p}".format(p=path)
+        return outputs[path]
+
+    def run(self):
+        while True:
+            start = time.time()
+            self.collect()
+            time.sleep(max(0, self.interval - (time.time() - start)))
+
+    def serve_forever(
+            self,
+            host,
+            port
+    ):
+        """
+        Collect in a background thread and serve the results over http
+        """
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                status, output = collector.get(self.path.rstrip('/') or '/nagios')
+                body = output.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('X-Check-Status', status)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if collector.debug:
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.serve_forever()
+
+
+def collector_client(
+        url,
+        timeout=10
+):
+    """
+    Fetch a result served by a DistrictsCollector
+
+    :param url: collector url, e.g. http://127.0.0.1:9393/nagios/my_district
+    :return: check state, output string
+    """
+    from urllib.request import urlopen
+
+    try:
+        response = urlopen(url, timeout=timeout)
+        status = response.headers.get('X-Check-Status', 'Unknown')
+        return status, response.read().decode('utf-8')
+    except Exception as e:
+        return 'Unknown', "Unknown: could not read collector result '{m}'".format(m=e)
+
+
+def openssh_broker(
+        **client_options
+):
+    """
+    :param client_options: OpenSSHControlClient arguments
+    :return: OpenSSHControlClient with an open master connection
+    """
+    return OpenSSHControlClient(**client_options).connect()
+
+
+def close_broker_future(
+        future,
+        debug=False
+):
+    """
+    Close the broker connection of a connection future once it is done
+    """
+    if not future.cancelled() and future.exception() is None:
+        close_broker_client(future.result(), debug)
+
+
+def connect_first_broker(
+        connect_brokers,
+        close_others=True,
+        timeout=None,
+        debug=False
+):
+    """
+    Connect to all the brokers at the same time and use the first one to
+    answer
+
+    :param connect_brokers: list of callables returning a broker ssh client,
+    raising an Exception when the connection fails
+    :param close_others: close the other connections once established
+    :param timeout: seconds to wait for a broker. By default wait forever
+    :return: broker ssh client
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-    # get broker server list
-    if opts.broker_hostname is None:
-        raise Exception("You must specify a broker server")
+    executor = ThreadPoolExecutor(max_workers=len(connect_brokers))
+    futures = [executor.submit(connect) for connect in connect_brokers]
+    errors = []
+    first = None
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            if future.exception() is None:
+                first = future
+                break
+            errors.append(str(future.exception()))
+            if debug:
+                print("Broker connection failed : {e}".format(e=future.exception()))
+    except FuturesTimeoutError:
+        errors.append("no answer after {t}s".format(t=timeout))
+    finally:
+        executor.shutdown(wait=False)
 
-    # get broker ssh user
-    if opts.broker_ssh_user is None:
-        raise Exception("You must specify a broker ssh user")
+    if first is None:
+        if close_others:
+            for future in futures:
+                future.add_done_callback(functools.partial(close_broker_future, debug=debug))
+        raise Exception("No broker answered : {e}".format(e=', '.join(errors)))
+
+    if close_others:
+        for future in futures:
+            if future is not first:
+                future.add_done_callback(functools.partial(close_broker_future, debug=debug))
+    return first.result()
+
+
+def connect_all_brokers(
+        connect_brokers,
+        close_late=True,
+        timeout=None,
+        debug=False
+):
+    """
+    Connect to all the brokers at the same time, the brokers not connected
+    before timeout are left out
+
+    :param connect_brokers: list of callables returning a broker ssh client,
+    raising an Exception when the connection fails
+    :param close_late: close the connections established after timeout
+    :param timeout: seconds to wait for the brokers. By default wait forever
+    :return: list of the connected broker ssh clients
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    executor = ThreadPoolExecutor(max_workers=len(connect_brokers))
+    futures = [executor.submit(connect) for connect in connect_brokers]
+    try:
+        done, late = wait(futures, timeout=timeout)
+    finally:
+        executor.shutdown(wait=False)
+
+    clients = []
+    errors = []
+    for future in futures:
+        if future in late:
+            errors.append("no answer after {t}s".format(t=timeout))
+            if debug:
+                print("Broker connection timed out after {t}s".format(t=timeout))
+            if close_late:
+                future.add_done_callback(functools.partial(close_broker_future, debug=debug))
+        elif future.exception() is None:
+            clients.append(future.result())
+        else:
+            errors.append(str(future.exception()))
+            if debug:
+                print("Broker connection failed : {e}".format(e=future.exception()))
+
+    if not clients:
+        raise Exception("No broker answered : {e}".format(e=', '.join(errors)))
+    return clients
+
+
+def shell_session_broker(
+        connect_broker,
+        shared=False,
+        debug=False
+):
+    """
+    Connect to the broker(s) and run their commands through one persistent
+    remote shell each, see ShellSessionClient
+
+    :param connect_broker: callable returning the broker ssh client, or a
+    list of them
+    :param shared: reuse the shell opened on the same client by the previous
+    checks of this process, else open a new one closed with the check
+    :return: ShellSessionClient, or list of them
+    """
+    if shared:
+        session = functools.partial(ShellSessionClient.get_shared_session, debug=debug)
+    else:
+        session = functools.partial(ShellSessionClient, debug=debug)
+
+    client = connect_broker()
+    if isinstance(client, list):
+        return [session(c) for c in client]
+    return session(client)
+
+
+def rate_limited_broker(
+        connect_broker,
+        limiter
+):
+    """
+    Connect to the broker(s) and start their commands once the limiter
+    allows it, see RateLimitedClient
+
+    :param connect_broker: callable returning the broker ssh client, or a
+    list of them
+    :param limiter: BrokerCallLimiter shared by all the brokers
+    :return: RateLimitedClient, or list of them
+    """
+    client = connect_broker()
+    if isinstance(client, list):
+        return [RateLimitedClient(c, limiter) for c in client]
+    return RateLimitedClient(client, limiter)
+
+
+def districts_limited_check(
+        check_districts,
+        limiter,
+        timer=None,
+        **kwargs
+):
+    """
+    Check the districts and time the broker calls wait in the limiter queue
+    as the mco_queue_wait phase
+
+    :param check_districts: callable returning the district_check results
+    :param limiter: BrokerCallLimiter of the broker clients
+    :param timer: PhaseTimer of the check
+    :param kwargs: check_districts arguments
+    :return: list of district_check results
+    """
+    timer = timer or PhaseTimer()
+    waited = limiter.waited
+    results = check_districts(timer=timer, **kwargs)
+    timer.add('mco_queue_wait', limiter.waited - waited)
+    return results
+
+
+def close_broker_client(
+        client,
+        debug=False
+):
+    """
+    Close the broker ssh client, or the list of them, at the end of a check
+
+    :param client: broker ssh client, list of them or None
+    """
+    for broker_client in (client if isinstance(client, list) else [client]):
+        if broker_client is None:
+            continue
+        try:
+            SSHHelper.close(broker_client)
+        except Exception as e:
+            if debug:
+                print("Broker connection close failed : {e}".format(e=e))
+
+
+def districts_check(
+        connect_broker,
+        connect_mongodb,
+        districts_options,
+        warning,
+        critical,
+        debug=False,
+        timer=None,
+        slowest=0,
+        deadline=None,
+        close_broker=True,
+        **mco_ping_options
+):
+    """
+    Connect to the broker and mongodb, load and check the districts one
+    after the other
+
+    :param connect_broker: callable returning the broker ssh client
+    :param connect_mongodb: callable returning the mongodb client and database
+    :param districts_options: load_districts arguments
+    :param timer: PhaseTimer timing each phase
+    :param slowest: number of slowest nodes to name in each district message
+    :param deadline: seconds the whole check may last, each district gets an
+    equal share of the time left for the mco pings
+    :param close_broker: close the broker ssh client at the end of the check
+    :param mco_ping_options: extra nodes_mco_ping_status arguments
+    :return: list of district_check results
+    """
+    timer = timer or PhaseTimer()
+    check_deadline = Deadline(deadline) if deadline is not None else None
+
+    with timer.phase('ssh_connect'):
+        client = connect_broker()
+    try:
+        with timer.phase('mongodb_connect'):
+            mongodb_client, mongodb_db = connect_mongodb()
+        try:
+            #get district(s)
+            #---------------
+            with timer.phase('district_query'):
+                districts = load_districts(
+                    mongodb_db,
+                    debug=debug,
+                    **districts_options
+                )
+        finally:
+            MongoDBHelper.close_mongodb_connection(mongodb_client)
+
+        return [
+            district_check(
+                client,
+                district,
+                district['name'],
+                warning,
+                critical,
+                debug,
+                timer=timer,
+                slowest=slowest,
+                deadline=check_deadline.split(len(districts) - index) if check_deadline else None,
+                **mco_ping_options
+            ) for index, district in enumerate(districts)
+        ]
+    finally:
+        if close_broker:
+            close_broker_client(client, debug)
+
+
+def mongodb_connect_and_auth(
+        mongodb_servers,
+        replicaset,
+        database_name,
+        username,
+        password,
+        source='admin',
+        read_preference=None,
+        connect_timeout=None,
+        server_selection_timeout=None,
+        shared=False
+):
+    """
+    Connect and authenticate to the openshift database
+
+    :param shared: reuse the mongodb client between calls
+    :return: mongodb client, authenticated database
+    """
+    mongodb_client = MongoDBHelper.get_mongodb_client(
+        mongodb_servers=mongodb_servers,
+        replicaset=replicaset,
+        username=username,
+        password=password,
+        source=source,
+        read_preference=read_preference,
+        connect_timeout=connect_timeout,
+        server_selection_timeout=server_selection_timeout,
+        shared=shared
+    )
+    return mongodb_client, mongodb_client[database_name]
+
+
+async def async_nodes_mco_ping_status(
+        loop,
+        executor,
+        client,
+        mongo_district_dict,
+        debug=False,
+        batch_size=0,
+        timeout=None,
+        cache=None,
+        state=None,
+        incremental_slice=10,
+        full_sweep_every=10,
+        deadline=None,
+        stop_after=None
+):
+    """
+    Coroutine pinging the district nodes through the executor threads, one
+    task per node or per batch of nodes. The outstanding tasks are cancelled
+    once the deadline expired or stop_after nodes did not answer
+
+    :return: same as nodes_mco_ping_status
+    """
+    import asyncio
+
+    if state is not None:
+        servers = mongo_district_dict['servers']
+        to_ping = incremental_ping_plan(
+            state.load().get(mongo_district_dict['name'], {}),
+            servers,
+            incremental_slice,
+            full_sweep_every
+        )
+        pinged_status = await async_nodes_mco_ping_status(
+            loop,
+            executor,
+            client,
+            {'servers': [server for server in servers if server['name'] in to_ping]},
+            debug,
+            batch_size,
+            timeout,
+            cache,
+            deadline=deadline,
+            stop_after=stop_after
+        )
+        with state.locked() as nodes_state:
+            return incremental_merge(
+                nodes_state.setdefault(mongo_district_dict['name'], {}),
+                servers,
+                pinged_status,
+                incremental_slice
+            )
+
+    servers_name = [server['name'] for server in mongo_district_dict['servers']]
+
+    cached_ping = {}
+    if cache is not None:
+        cached_ping = await loop.run_in_executor(
+            executor,
+            cache.get_many,
+            servers_name
+        )
+        cached_ping = {
+            name: cached_mco_ping(ping)
+            for name, ping in cached_ping.items()
+        }
+        servers_name = [name for name in servers_name if name not in cached_ping]
+
+    deadline = deadline or Deadline()
+    if stop_after is not None:
+        stop_after = max(stop_after - sum(1 for ping in cached_ping.values() if not ping[0]), 0)
+
+    #the tasks are spread over the brokers sharing the nodes, the pings
+    #still running once the verdict is reached are closed
+    clients = [
+        TrackedClient(c) for c in (client if isinstance(client, list) else [client])
+    ]
+
+    #task -> pinged node name, None for a batch task
+    pending = {}
+    if batch_size > 0:
+        for i in range(0, len(servers_name), batch_size):
+            pending[loop.run_in_executor(
+                executor,
+                nodes_mco_batch_ping,
+                clients[(i // batch_size) % len(clients)],
+                servers_name[i:i + batch_size],
+                debug,
+                timeout,
+                deadline
+            )] = None
+    else:
+        for i, server_name in enumerate(servers_name):
+            pending[loop.run_in_executor(
+                executor,
+                node_mco_ping,
+                clients[i % len(clients)],
+                server_name,
+                debug,
+                timeout,
+                deadline
+            )] = server_name
+
+    servers_ping = {}
+    while pending and not verdict_reached(servers_ping, stop_after):
+        done, _ = await asyncio.wait(
+            list(pending),
+            timeout=deadline.remaining(),
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for task in done:
+            server_name = pending.pop(task)
+            if server_name is None:
+                servers_ping.update(task.result())
+            elif task.result() is not None:
+                servers_ping[server_name] = task.result()
+    for task in pending:
+        task.cancel()
+    for tracked_client in clients:
+        tracked_client.close_channels()
+
+    if cache is not None:
+        await loop.run_in_executor(executor, cache.set_many, servers_ping)
+        servers_ping.update(cached_ping)
+
+    return mco_servers_status(servers_ping)
+
+
+async def async_districts_pipeline(
+        loop,
+        executor,
+        connect_broker,
+        connect_mongodb,
+        districts_options,
+        warning,
+        critical,
+        debug=False,
+        batch_size=0,
+        timeout=None,
+        cache=None,
+        timer=None,
+        slowest=0,
+        state=None,
+        incremental_slice=10,
+        full_sweep_every=10,
+        deadline=None,
+        close_broker=True
+):
+    """
+    Coroutine overlapping the broker ssh connection with the mongodb
+    connection and district query, the pings start once both are done and
+    share the time left before the deadline
+
+    :param close_broker: close the broker ssh client at the end of the check,
+    even when the check failed before it was connected
+    """
+    import asyncio
+
+    timer = timer or PhaseTimer()
+
+    broker_connection = executor.submit(timer.wrap('ssh_connect', connect_broker))
+    try:
+        mongodb_client, mongodb_db = await loop.run_in_executor(
+            executor,
+            timer.wrap('mongodb_connect', connect_mongodb)
+        )
+        try:
+            districts = await loop.run_in_executor(
+                executor,
+                timer.wrap(
+                    'district_query',
+                    functools.partial(
+                        load_districts,
+                        mongodb_db,
+                        debug=debug,
+                        **districts_options
+                    )
+                )
+            )
+        finally:
+            MongoDBHelper.close_mongodb_connection(mongodb_client)
+
+        client = await asyncio.wrap_future(broker_connection, loop=loop)
+
+        with timer.phase('mco_ping'):
+            districts_mco_status = await asyncio.gather(*[
+                async_nodes_mco_ping_status(
+                    loop,
+                    executor,
+                    client,
+                    district,
+                    debug,
+                    batch_size,
+                    timeout,
+                    cache,
+                    state,
+                    incremental_slice,
+                    full_sweep_every,
+                    deadline,
+                    critical if deadline is not None else None
+                ) for district in districts
+            ])
+
+        return [
+            district_check(
+                client,
+                district,
+                district['name'],
+                warning,
+                critical,
+                debug,
+                mco_servers_status=mco_status,
+                slowest=slowest,
+                deadline=deadline
+            ) for district, mco_status in zip(districts, districts_mco_status)
+        ]
+    finally:
+        if close_broker:
+            #runs now, or once a still pending connection is established
+            broker_connection.add_done_callback(
+                functools.partial(close_broker_future, debug=debug)
+            )
+
+
+def async_districts_check(
+        connect_broker,
+        connect_mongodb,
+        districts_options,
+        warning,
+        critical,
+        debug=False,
+        batch_size=0,
+        workers=1,
+        timeout=None,
+        cache=None,
+        timer=None,
+        slowest=0,
+        state=None,
+        incremental_slice=10,
+        full_sweep_every=10,
+        deadline=None,
+        close_broker=True
+):
+    """
+    Run the districts check with the asyncio pipeline, the blocking paramiko
+    and pymongo calls run in a pool of workers threads
+
+    :param connect_broker: callable returning the broker ssh client
+    :param connect_mongodb: callable returning the mongodb client and database
+    :param districts_options: load_districts arguments
+    :param deadline: seconds the whole check may last
+    :param close_broker: close the broker ssh client at the end of the check
+    :return: list of district_check results
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=max(workers, 2))
+    try:
+        return loop.run_until_complete(
+            async_districts_pipeline(
+                loop,
+                executor,
+                connect_broker,
+                connect_mongodb,
+                districts_options,
+                warning,
+                critical,
+                debug,
+                batch_size,
+                timeout,
+                cache,
+                timer,
+                slowest,
+                state,
+                incremental_slice,
+                full_sweep_every,
+                Deadline(deadline) if deadline is not None else None,
+                close_broker
+            )
+        )
+    finally:
+        executor.shutdown(wait=False)
+        loop.close()
+
+
+def node_check_config(
+        config=None
+):
+    """
+    Complete a check configuration with the command line defaults
+
+    :param config: dict of option values named after the command line
+    options destinations, e.g. {'broker_hostname': 'broker', 'warning': 3},
+    or the optparse.Values of a parsed command line
+    :return: optparse.Values of the whole configuration
+    """
+    if isinstance(config, optparse.Values):
+        config = vars(config)
+
+    opts = parser.get_default_values()
+    for name, value in (config or {}).items():
+        if not hasattr(opts, name):
+            raise Exception("Unknown check option {o}".format(o=name))
+        setattr(opts, name, value)
+    return opts
+
+
+def node_check_setup(
+        opts,
+        broker_client=None,
+        mongodb_client=None,
+        shared=False
+):
+    """
+    Validate the check configuration and prepare the districts check
+
+    :param opts: optparse.Values, see node_check_config
+    :param broker_client: already connected broker ssh client to use
+    :param mongodb_client: already connected mongodb client to use, it is
+    left open
+    :param shared: reuse the broker and mongodb connections between the
+    checks of this process
+    :return: districts check callable, True when several districts are checked
+    """
+
+    #Broker ssh args
+    #---------------
+
+    if broker_client is None:
+        # get broker server list
+        if not opts.broker_hostname:
+            raise Exception("You must specify a broker server")
+
+        # get broker ssh user
+        if opts.broker_ssh_user is None:
+            raise Exception("You must specify a broker ssh user")
 
     broker_ssh_host = opts.broker_hostname
+    broker_ssh_hosts = [host.strip() for host in broker_ssh_host.split(',') if host.strip()]
     broker_ssh_port = opts.broker_ssh_port
     broker_ssh_user = opts.broker_ssh_user
     broker_ssh_key_path = opts.broker_ssh_key_file
     broker_ssh_passphrase = opts.broker_ssh_passphrase
+    broker_ssh_agent = opts.broker_ssh_agent
+    broker_ssh_keepalive = opts.broker_ssh_keepalive
+    broker_ssh_control_path = opts.broker_ssh_control_path
+    broker_ssh_control_persist = opts.broker_ssh_control_persist
+
+    # the district passive results default to the first broker host
+    if (opts.passive_command_file or opts.passive_spool_dir) and \
+            not (opts.passive_district_host or broker_ssh_hosts):
+        raise Exception("You must specify a passive district host")
 
     #MongpDB args
     #------------
 
-    # get mongodb server list
-    if opts.mongo_hostnames is None:
-        raise Exception("You must specify a mongodb servers list")
+    if mongodb_client is None:
+        # get mongodb server list
+        if opts.mongo_hostnames is None:
+            raise Exception("You must specify a mongodb servers list")
 
-    # get mongodb user
-    if opts.mongo_user is None:
-        raise Exception("You must specify a mongodb user")
+        # get mongodb user
+        if opts.mongo_user is None:
+            raise Exception("You must specify a mongodb user")
 
-    # get mongodb user password
-    if opts.mongo_password is None:
-        raise Exception("You must specify a mongodb user password")
+        # get mongodb user password
+        if opts.mongo_password is None:
+            raise Exception("You must specify a mongodb user password")
 
-    # get mongodb source logon
-    if opts.mongo_source is None:
-        raise Exception("You must specify a mongodb source longon")
+        # get mongodb source logon
+        if opts.mongo_source is None:
+            raise Exception("You must specify a mongodb source longon")
+
+        # get mongodb database replicaset
+        if opts.mongo_replicaset is None:
+            raise Exception("You must specify a mongodb database replicaset name")
 
     # get mongodb openshift database name
     if opts.mongo_openshift_database is None:
         raise Exception("You must specify a mongodb openshift database name")
 
-    # get mongodb database replicaset
-    if opts.mongo_replicaset is None:
-        raise Exception("You must specify a mongodb database replicaset name")
-
-    mongodb_hostnames_array = opts.mongo_hostnames.split(' ')
     mongodb_user = opts.mongo_user
     mongodb_password = opts.mongo_password
     mongodb_logon_source = opts.mongo_source
     mongodb_openshift_db = opts.mongo_openshift_database
     mongodb_replicaset = opts.mongo_replicaset
+    mongodb_aggregate = opts.mongo_aggregate
+    mongodb_read_preference = opts.mongo_read_preference
+    mongodb_connect_timeout = opts.mongo_connect_timeout
+    mongodb_server_selection_timeout = opts.mongo_server_selection_timeout
 
     #Openshift related args
     #----------------------
 
-    #Get district name
-    if opts.openshift_district is None:
-        raise Exception("You must specify a openshift district name")
-
-    openshift_district_name = opts.openshift_district
+    #Get district name(s)
+    openshift_all_districts = opts.openshift_all_districts
+    openshift_district_pattern = opts.openshift_district_pattern
+    openshift_district_names = []
+    if opts.openshift_district:
+        openshift_district_names = [
+            name.strip() for name in opts.openshift_district.split(',') if name.strip()
+        ]
 
+    if not (openshift_district_names or openshift_district_pattern or openshift_all_districts):
+        raise Exception("You must specify a openshift district name")
 
+    multi_district = (
+        openshift_all_districts or
+        openshift_district_pattern is not None or
+        len(openshift_district_names) > 1
+    )
 
     # Try to get numeic warning/critical values
     s_warning = opts.warning or DEFAULT_WARNING
@@ -337,137 +2423,549 @@ if __name__ == '__main__':
 
     debug = opts.debug
 
-    try:
-        # Ok now got an object that link to our destination
-        client = SSHHelper.connect(
-            hostname=broker_ssh_host,
-            user=broker_ssh_user,
-            ssh_key_file=broker_ssh_key_path,
-            passphrase=broker_ssh_passphrase,
-            port=broker_ssh_port
+    mco_batch_size = 0
+    if opts.mco_batch:
+        if opts.mco_batch_size <= 0:
+            raise Exception("The mco batch size must be greater than 0")
+        mco_batch_size = opts.mco_batch_size
+
+    if opts.mco_workers < 1:
+        raise Exception("The mco workers number must be at least 1")
+    mco_workers = opts.mco_workers
+    mco_timeout = opts.mco_timeout
+
+    if opts.broker_connect_timeout <= 0:
+        raise Exception("The broker connect timeout must be greater than 0")
+    connect_timeout = opts.broker_connect_timeout
+
+    #the connections may each use a quarter of the deadline, the pings get the rest
+    deadline = opts.deadline
+    if deadline is not None:
+        if deadline <= 0:
+            raise Exception("The deadline must be greater than 0")
+        connect_timeout = min(connect_timeout, deadline / 4.0)
+        mongodb_connect_timeout = min(mongodb_connect_timeout, connect_timeout)
+        mongodb_server_selection_timeout = min(mongodb_server_selection_timeout, connect_timeout)
+
+    mco_cache = None
+    if opts.mco_cache_file:
+        mco_cache = FileTTLCache(
+            opts.mco_cache_file,
+            opts.mco_cache_ttl,
+            namespace=broker_ssh_host
         )
 
-        #Connecto to MongoDB
-        #-------------------
-        mongodb_client = MongoDBHelper.get_mongodb_connection_to_db(
-            mongodb_servers=mongodb_hostnames_array,
-            replicaset=mongodb_replicaset
+    # Ok now got an object that link to our destination
+    if broker_client is not None:
+        # the caller owns the client, closing the check wrappers leaves it open
+        connect_broker = lambda: BorrowedClient(broker_client)
+    else:
+        several_brokers = len(broker_ssh_hosts) > 1
+        if broker_ssh_control_path:
+            connect_host = functools.partial(
+                openssh_broker if several_brokers else OpenSSHControlClient,
+                port=broker_ssh_port,
+                user=broker_ssh_user,
+                control_path=broker_ssh_control_path,
+                control_persist=broker_ssh_control_persist,
+                ssh_key_file=broker_ssh_key_path,
+                keepalive=broker_ssh_keepalive,
+                connect_timeout=connect_timeout
+            )
+        else:
+            connect_host = functools.partial(
+                SSHHelper.get_shared_client if shared else SSHHelper.connect,
+                user=broker_ssh_user,
+                ssh_key_file=broker_ssh_key_path,
+                passphrase=broker_ssh_passphrase,
+                port=broker_ssh_port,
+                keepalive=broker_ssh_keepalive,
+                allow_agent=broker_ssh_agent,
+                timeout=connect_timeout,
+                exit_on_error=False
+            )
+
+        if several_brokers:
+            connect_brokers = [
+                functools.partial(connect_host, hostname=host) for host in broker_ssh_hosts
+            ]
+            if opts.broker_shard:
+                connect_broker = functools.partial(
+                    connect_all_brokers,
+                    connect_brokers,
+                    close_late=not shared,
+                    timeout=connect_timeout,
+                    debug=debug
+                )
+            else:
+                connect_broker = functools.partial(
+                    connect_first_broker,
+                    connect_brokers,
+                    close_others=not shared,
+                    timeout=connect_timeout,
+                    debug=debug
+                )
+        else:
+            connect_broker = functools.partial(connect_host, hostname=broker_ssh_host)
+
+    if opts.broker_shell_session:
+        connect_broker = functools.partial(
+            shell_session_broker,
+            connect_broker,
+            shared=shared,
+            debug=debug
         )
 
-        mongodb_db = MongoDBHelper.get_mongodb_auth_db(
-            mongodb_client=mongodb_client,
+    limiter = None
+    if opts.mco_limit_slots or opts.mco_limit_rate:
+        if opts.mco_limit_slots < 0 or opts.mco_limit_rate < 0:
+            raise Exception("The mco limits can not be negative")
+        limiter = BrokerCallLimiter(
+            opts.mco_limit_file,
+            slots=opts.mco_limit_slots,
+            rate=opts.mco_limit_rate,
+            burst=opts.mco_limit_burst
+        )
+        connect_broker = functools.partial(rate_limited_broker, connect_broker, limiter)
+
+    #Connecto to MongoDB
+    #-------------------
+    if mongodb_client is not None:
+        # the caller owns the client, there is nothing to close
+        connect_mongodb = lambda: (None, mongodb_client[mongodb_openshift_db])
+    else:
+        connect_mongodb = functools.partial(
+            mongodb_connect_and_auth,
+            mongodb_servers=opts.mongo_hostnames.split(' '),
+            replicaset=mongodb_replicaset,
             database_name=mongodb_openshift_db,
             username=mongodb_user,
             password=mongodb_password,
-            source=mongodb_logon_source
+            source=mongodb_logon_source,
+            read_preference=mongodb_read_preference,
+            connect_timeout=mongodb_connect_timeout,
+            server_selection_timeout=mongodb_server_selection_timeout,
+            shared=shared
         )
 
-        #get district
-        #------------
-        district = openshift_district(
-            mongodb_db_connection=mongodb_db,
-            district_name=openshift_district_name,
+    districts_options = {
+        'district_names': openshift_district_names,
+        'district_pattern': openshift_district_pattern,
+        'all_districts': openshift_all_districts,
+        'aggregate': mongodb_aggregate
+    }
+    mco_ping_options = {
+        'batch_size': mco_batch_size,
+        'workers': mco_workers,
+        'timeout': mco_timeout,
+        'cache': mco_cache,
+        'state': StateFile(opts.state_file) if opts.state_file else None,
+        'incremental_slice': opts.incremental_slice,
+        'full_sweep_every': opts.full_sweep_every
+    }
+
+    if opts.collector_listen and opts.collector_mongo_watch:
+        watched_client, mongodb_db = connect_mongodb()
+        watcher = MongoDBCollectionWatcher(
+            mongodb_db['districts'],
+            fields=('name', 'servers'),
             debug=debug
         )
-        if debug:
-            pprint(district)
+        if not watcher.start(timeout=mongodb_server_selection_timeout):
+            raise Exception("Could not load the openshift districts")
+        districts_options['watcher'] = watcher
+
+    check_districts = functools.partial(
+        async_districts_check if opts.async_pipeline else districts_check,
+        connect_broker,
+        connect_mongodb,
+        districts_options,
+        s_warning,
+        s_critical,
+        debug,
+        slowest=opts.mco_slowest,
+        deadline=deadline,
+        #the next checks of this process keep using the broker client
+        close_broker=not shared,
+        **mco_ping_options
+    )
+    if limiter is not None:
+        check_districts = functools.partial(districts_limited_check, check_districts, limiter)
+
+    if opts.status_history:
+        if not 0 < opts.flap_threshold <= 100:
+            raise Exception("The flap threshold must be a percent between 0 and 100")
+        check_districts = functools.partial(
+            districts_history_check,
+            check_districts,
+            NodeStatusHistory(opts.status_history, opts.status_history_samples),
+            opts.flap_threshold
+        )
 
-        #get server db status
-        #--------------------
-        servers_db_status = servers_status(district)
-        if debug:
-            print("mongodb servers status")
-            pprint(servers_db_status)
+    return check_districts, multi_district
 
-        #get unresponsive/active count from the db
-        db_nb_unresponsive_servers = nb_unresponsive_servers(servers_db_status)
-        db_nb_active_servers = nb_active_servers(servers_db_status)
 
-        #get mco ping responce
-        #---------------------
-        ssh_mco_servers_status = nodes_mco_ping_status(
-            client,
-            district,
-            debug
+def run_node_check(
+        config,
+        broker_client=None,
+        mongodb_client=None,
+        shared=False,
+        timer=None
+):
+    """
+    Run the nodes check in process, e.g. from a poller module : the plugin
+    never exits and errors are reported as a Critical result
+
+    :param config: dict of option values named after the command line
+    options destinations, see node_check_config
+    :param broker_client: already connected broker ssh client to use
+    :param mongodb_client: already connected mongodb client to use, it is
+    left open
+    :param shared: reuse the broker and mongodb connections between the
+    checks of this process
+    :param timer: PhaseTimer of the check, its start is the deadline start
+    :return: CheckResult
+    """
+    timer = timer or PhaseTimer()
+    opts = node_check_config(config)
+
+    try:
+        check_districts, multi_district = node_check_setup(
+            opts,
+            broker_client,
+            mongodb_client,
+            shared
         )
-        if debug:
-            print("mco servers status")
-            pprint(ssh_mco_servers_status)
-
-        #get unresponsive/active count from remote mco ping
-        nb_mco_ping_active_servers = nb_active_servers(ssh_mco_servers_status)
-        nb_mco_ping_unresponsive_servers = nb_unresponsive_servers(ssh_mco_servers_status)
-
-        #format perf data
-        db_active_servers_data_string = OutputFormatHelpers.perf_data_string(
-            label="{d}_mongodb_active_nodes".format(d=openshift_district_name),
-            value=db_nb_active_servers,
-        )
-        db_unresponsive_servers_data_string = OutputFormatHelpers.perf_data_string(
-            label="{d}_mongodb_unresponsive_servers".format(d=openshift_district_name),
-            value=db_nb_unresponsive_servers,
-            warn=s_warning,
-            crit=s_critical
-        )
-        mco_active_servers_data_string = OutputFormatHelpers.perf_data_string(
-            label="{d}_mco_active_nodes".format(d=openshift_district_name),
-            value=nb_mco_ping_active_servers,
-        )
-        mco_unresponsive_servers_data_string = OutputFormatHelpers.perf_data_string(
-            label="{d}_mco_unresponsive_servers".format(d=openshift_district_name),
-            value=nb_mco_ping_unresponsive_servers,
-            warn=s_warning,
-            crit=s_critical
-        )
-
-        #check
-        nb_unresponsive_servers = max(db_nb_unresponsive_servers,nb_mco_ping_unresponsive_servers)
-        nb_active_servers = max(db_nb_active_servers,nb_mco_ping_active_servers)
-
-        status = "OK"
-        state = "active"
-        nb = nb_active_servers
-        if nb_unresponsive_servers >= s_warning:
-            status = "Warning"
-            state = "unresponsive"
-            nb = nb_unresponsive_servers
-        if nb_unresponsive_servers >= s_critical:
-            status = "Critical"
-            state = "unresponsive"
-            nb = nb_unresponsive_servers
-
-        #Format and print check result
-        message = "{nb} {state} openshift nodes".format(
-            nb=nb,
-            state=state
-        )
-        output = OutputFormatHelpers.check_output_string(
-            status,
-            message,
-            [
-                db_active_servers_data_string,
-                db_unresponsive_servers_data_string,
-                mco_active_servers_data_string,
-                mco_unresponsive_servers_data_string
-            ]
+
+        results = check_districts(
+            timer=timer,
+            #the time spent before the check started counts
+            deadline=opts.deadline - timer.elapsed() if opts.deadline is not None else None
         )
 
-        print(output)
-        
+        if opts.passive_command_file or opts.passive_spool_dir:
+            check_results = passive_check_results(
+                results,
+                opts.passive_district_host or opts.broker_hostname.split(',')[0].strip(),
+                opts.passive_district_service,
+                opts.passive_node_service,
+                opts.passive_node_host_checks
+            )
+            if opts.passive_command_file:
+                PassiveCheckHelpers.write_command_file(opts.passive_command_file, check_results)
+            if opts.passive_spool_dir:
+                PassiveCheckHelpers.write_spool_dir(opts.passive_spool_dir, check_results)
+
+        prefix = "{d}_".format(d='districts' if multi_district else results[0]['name'])
+        timing_perfdata = None
+        if opts.timing:
+            timing_perfdata = timer.perf_data(
+                prefix=prefix,
+                warn=opts.timing_warning if opts.timing_warning is not None else '',
+                crit=opts.timing_critical if opts.timing_critical is not None else ''
+            )
+        elif opts.mco_limit_slots or opts.mco_limit_rate:
+            #the queue wait is reported even without the phases timing
+            timing_perfdata = [
+                OutputFormatHelpers.perf_data_string(
+                    label="{p}mco_queue_wait_time".format(p=prefix),
+                    value=int(round(timer.phases.get('mco_queue_wait', 0) * 1000)),
+                    UOM='ms',
+                    min=0
+                )
+            ]
+
+        #Format check result
+        status, output = OutputFormatHelpers.districts_check_output(
+            results,
+            multi_district,
+            timing_perfdata
+        )
+        return CheckResult(status, output, results)
 
     except Exception as e:
-        if debug:
+        if opts.debug:
             print(e)
             the_type, value, tb = sys.exc_info()
             traceback.print_tb(tb)
-        print("Error: {m}".format(m=e))
-        sys.exit(2)
+        return CheckResult("Critical", "Error: {m}".format(m=e))
 
-    finally:
-        if mongodb_client is not None:
-            MongoDBHelper.close_mongodb_connection(mongodb_client)
-        if status == "Critical":
+
+# OPT parsing
+# -----------
+parser = optparse.OptionParser(
+    "%prog [options]", version="%prog " + version)
+
+#broker ssh param
+parser.add_option('--broker-hostname', default='',
+                  dest="broker_hostname",
+                  help='Broker to connect to, or comma separated list of brokers. The brokers are '
+                       'connected at the same time and the first one to answer is used')
+parser.add_option('--broker-shard',
+                  dest="broker_shard", default=False, action="store_true",
+                  help='With several brokers, split the nodes of each district between all the '
+                       'brokers that answered and ping the shares at the same time')
+parser.add_option('--broker-ssh-port',
+                  dest="broker_ssh_port", type="int", default=22,
+                  help='SSH port to connect to the broker. Default : 22')
+parser.add_option('--broker-ssh-key', default=os.path.expanduser('~/.ssh/id_rsa'),
+                  dest="broker_ssh_key_file", help='SSH key file to use. By default will take ~/.ssh/id_rsa.')
+parser.add_option('--broker-ssh-user', default='shinken',
+                  dest="broker_ssh_user", help='remote use to use. By default shinken.')
+parser.add_option('--broker-passphrase', default='',
+                  dest="broker_ssh_passphrase", help='SSH key passphrase. By default will use void')
+parser.add_option('--broker-ssh-agent',
+                  dest="broker_ssh_agent", default=False, action="store_true",
+                  help='Also try the ssh-agent and ~/.ssh keys, the only keys tried when the ssh key file is missing. '
+                       'By default only the ssh key file is used')
+parser.add_option('--broker-connect-timeout',
+                  dest="broker_connect_timeout", type="float", default=10,
+                  help='Seconds to wait for the broker connection, the brokers not connected in time '
+                       'are left out. Default : 10')
+parser.add_option('--broker-ssh-keepalive',
+                  dest="broker_ssh_keepalive", type="int", default=30,
+                  help='Seconds between ssh keepalive packets. Default : 30')
+parser.add_option('--broker-ssh-control-path',
+                  dest="broker_ssh_control_path", default=None,
+                  help='Run the broker commands with the system ssh client through this '
+                       'OpenSSH ControlMaster socket, so the next checks reuse the '
+                       'authenticated connection. The key must be unencrypted or in the ssh-agent. '
+                       'Example : ~/.ssh/check-openshift-%r@%h:%p')
+parser.add_option('--broker-ssh-control-persist',
+                  dest="broker_ssh_control_persist", type="int", default=600,
+                  help='Seconds the ControlMaster connection stays open after the last check. Default : 600')
+parser.add_option('--broker-shell-session',
+                  dest="broker_shell_session", default=False, action="store_true",
+                  help='Run all the broker commands through one persistent remote shell instead of '
+                       'a new channel and shell per command. The commands then run one at a time')
+
+#mongodb connection
+parser.add_option('--mongo-hostname',
+                  dest="mongo_hostnames",
+                  help='space separated mongodb hostnames:port list to connect to. '
+                       'Example :  "server1:27017 server2:27017" ')
+parser.add_option('--mongo-user',
+                  dest="mongo_user", default="shinken",
+                  help='remote use to use. By default shinken.')
+parser.add_option('--mongo-password',
+                  dest="mongo_password",
+                  help='Password. By default will use void')
+parser.add_option('--mongo-source-longon',
+                  dest="mongo_source", default='admin',
+                  help='Source where to log on. Default: admin')
+parser.add_option('--mongo-replicaset',
+                  dest="mongo_replicaset",
+                  help='openshift current mongodb replicaset')
+parser.add_option('--mongo-openshift-database-name',
+                  dest="mongo_openshift_database",
+                  help='openshift current database')
+
+#openshift relative
+parser.add_option('--openshift-district-name',
+                  dest="openshift_district",
+                  help='openshift district to query. A comma separated list checks '
+                       'several districts in one run')
+parser.add_option('--mongo-read-preference',
+                  dest="mongo_read_preference", default='primary',
+                  help='Read preference of the district queries, e.g. secondaryPreferred. '
+                       'Default : primary')
+parser.add_option('--mongo-connect-timeout',
+                  dest="mongo_connect_timeout", type="float", default=5,
+                  help='Seconds to wait for a mongodb connection. Default : 5')
+parser.add_option('--mongo-server-selection-timeout',
+                  dest="mongo_server_selection_timeout", type="float", default=10,
+                  help='Seconds to wait for a suitable mongodb server, e.g. during a '
+                       'primary election. Default : 10')
+parser.add_option('--mongo-aggregate',
+                  dest="mongo_aggregate", default=False, action="store_true",
+                  help='Count the active and unresponsive nodes inside mongodb, only the '
+                       'node names and the names of the nodes not active or unresponsive are '
+                       'sent back')
+parser.add_option('--openshift-all-districts',
+                  dest="openshift_all_districts", default=False, action="store_true",
+                  help='Check all the openshift districts in one run')
+parser.add_option('--openshift-district-pattern',
+                  dest="openshift_district_pattern", default=None,
+                  help='Check all the openshift districts matching this regular expression')
+parser.add_option('--mco-batch',
+                  dest="mco_batch", default=False, action="store_true",
+                  help='Ping all the district nodes with batched mco rpc calls '
+                       'instead of one call per node. The nodes of a batch answer all at once, '
+                       'so no mco round trip time nor slowest nodes are reported')
+parser.add_option('--mco-batch-size',
+                  dest="mco_batch_size", type="int", default=200,
+                  help='Number of node identities per batched mco rpc call. Default : 200')
+parser.add_option('--mco-workers',
+                  dest="mco_workers", type="int", default=1,
+                  help='Number of nodes pinged at the same time, each over its own '
+                       'channel of the broker ssh connection. Keep it below the broker '
+                       'sshd MaxSessions. Default : 1')
+parser.add_option('--mco-timeout',
+                  dest="mco_timeout", type="float", default=None,
+                  help='Seconds to wait for each node mco ping answer before '
+                       'reporting it unresponsive. By default wait forever')
+parser.add_option('--mco-cache-file',
+                  dest="mco_cache_file", default=None,
+                  help='File caching the mco ping results, shared by all the checks '
+                       'using the same broker. By default no cache')
+parser.add_option('--mco-cache-ttl',
+                  dest="mco_cache_ttl", type="float", default=30,
+                  help='Seconds a cached mco ping result stays valid. Default : 30')
+parser.add_option('--state-file',
+                  dest="state_file", default=None,
+                  help='File keeping the last known nodes status between runs. Only the '
+                       'suspect nodes and a rotating slice of the healthy ones are then pinged')
+parser.add_option('--incremental-slice',
+                  dest="incremental_slice", type="int", default=10,
+                  help='Number of healthy nodes pinged on each incremental run. Default : 10')
+parser.add_option('--full-sweep-every',
+                  dest="full_sweep_every", type="int", default=10,
+                  help='Ping all the nodes every N incremental runs. Default : 10')
+parser.add_option('--mco-limit-slots',
+                  dest="mco_limit_slots", type="int", default=0,
+                  help='Broker mco calls running at the same time, shared by all the checks of this '
+                       'host. Default : 0, no limit')
+parser.add_option('--mco-limit-rate',
+                  dest="mco_limit_rate", type="float", default=0,
+                  help='Broker mco calls per second, shared by all the checks of this host. '
+                       'Default : 0, no limit')
+parser.add_option('--mco-limit-burst',
+                  dest="mco_limit_burst", type="int", default=None,
+                  help='Broker mco calls allowed at once by --mco-limit-rate. Default : the rate')
+parser.add_option('--mco-limit-file',
+                  dest="mco_limit_file", default='~/.check-openshift/mco',
+                  help='Prefix of the lock and state files shared by the limited checks, its '
+                       'directory must not be writable by other users. '
+                       'Default : ~/.check-openshift/mco')
+parser.add_option('--status-history',
+                  dest="status_history", default=None,
+                  help='Record the status of every node in this memory mapped history file and '
+                       'report the flapping nodes apart from the nodes staying down')
+parser.add_option('--status-history-samples',
+                  dest="status_history_samples", type="int", default=64,
+                  help='Last status samples kept per node in the history file. Default : 64')
+parser.add_option('--flap-threshold',
+                  dest="flap_threshold", type="float", default=30,
+                  help='Percent of status changes in the node history from which a node is '
+                       'flapping. Default : 30')
+parser.add_option('--mco-slowest',
+                  dest="mco_slowest", type="int", default=0,
+                  help='Name the N slowest nodes to answer the mco ping in the output, not '
+                       'available with --mco-batch. Default : 0')
+parser.add_option('-w', '--warning',
+                  dest="warning", type="int",default=None,
+                  help='Warning value for number of unresponsive nodes. Default : 2')
+parser.add_option('-c', '--critical',
+                  dest="critical", type="int",default=None,
+                  help='Critical value for number of unresponsive nodes. Default : 3')
+parser.add_option('--deadline',
+                  dest="deadline", type="float", default=None,
+                  help='Seconds the whole check may last, keep it below the Shinken timeout. '
+                       'The broker and mongodb connections may each use a quarter of it, the '
+                       'mco pings share the time left and stop once critical nodes did not '
+                       'answer. The nodes left unchecked are reported. Default : no deadline')
+
+parser.add_option('--async',
+                  dest="async_pipeline", default=False, action="store_true",
+                  help='Connect to the broker while querying mongodb and ping the nodes '
+                       'of all the districts concurrently, up to --mco-workers at a time')
+
+#timing
+parser.add_option('--timing',
+                  dest="timing", default=False, action="store_true",
+                  help='Report the duration of each check phase and the total check '
+                       'runtime as perf data in milliseconds')
+parser.add_option('--timing-warning',
+                  dest="timing_warning", type="int", default=None,
+                  help='Warning level of the total runtime perf data in milliseconds')
+parser.add_option('--timing-critical',
+                  dest="timing_critical", type="int", default=None,
+                  help='Critical level of the total runtime perf data in milliseconds')
+
+#collector
+parser.add_option('--collector-listen',
+                  dest="collector_listen", default=None,
+                  help='Run as a collector checking the districts every --collector-interval '
+                       'seconds and serving the results on this host:port. '
+                       'Paths : /nagios, /nagios/<district>, /metrics (prometheus)')
+parser.add_option('--collector-interval',
+                  dest="collector_interval", type="int", default=60,
+                  help='Seconds between two collector checks. Default : 60')
+parser.add_option('--collector-mongo-watch',
+                  dest="collector_mongo_watch", default=False, action="store_true",
+                  help='Keep the districts in the collector memory, following their changes '
+                       'through a change stream or the oplog instead of querying them each time')
+parser.add_option('--collector-url',
+                  dest="collector_url", default=None,
+                  help='Print the result served by a collector instead of checking, '
+                       'e.g. http://127.0.0.1:9393/nagios/my_district')
+
+#passive results
+parser.add_option('--passive-command-file',
+                  dest="passive_command_file", default=None,
+                  help='Also submit one passive result per district and per node to this '
+                       'Nagios/Shinken external command file, in atomic writes of whole lines')
+parser.add_option('--passive-spool-dir',
+                  dest="passive_spool_dir", default=None,
+                  help='Also submit one passive result per district and per node as a check '
+                       'result file of this Nagios check_result_path directory')
+parser.add_option('--passive-district-host',
+                  dest="passive_district_host", default=None,
+                  help='Host name of the districts passive services, required when no broker hostname is given. '
+                       'Default : the broker hostname')
+parser.add_option('--passive-district-service',
+                  dest="passive_district_service", default='openshift_district_{district}',
+                  help='Service description of a district passive result, {district} is '
+                       'replaced by its name. Default : openshift_district_{district}')
+parser.add_option('--passive-node-service',
+                  dest="passive_node_service", default='openshift_node',
+                  help='Service description of the nodes passive results, the host name is '
+                       'the node identity. Default : openshift_node')
+parser.add_option('--passive-node-host-checks',
+                  dest="passive_node_host_checks", default=False, action="store_true",
+                  help='Also submit a passive host result per pinged node, UP when it answered '
+                       'the mco ping')
+
+#generic
+parser.add_option('--debug',
+                  dest="debug", default=False, action="store_true",
+                  help='Enable debug')
+
+if __name__ == '__main__':
+
+    timer = PhaseTimer()
+
+    # Ok first job : parse args
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("Does not accept any argument.")
+
+    # Thin client of a running collector
+    if opts.collector_url:
+        status, output = collector_client(opts.collector_url)
+        print(output)
+        sys.exit(OutputFormatHelpers.exit_code(status))
+
+    if opts.collector_listen:
+        try:
+            check_districts, multi_district = node_check_setup(opts, shared=True)
+            collector_host, collector_port = opts.collector_listen.rsplit(':', 1)
+            collector = DistrictsCollector(
+                check_districts,
+                multi_district,
+                interval=opts.collector_interval,
+                debug=opts.debug
+            )
+            collector.serve_forever(collector_host, int(collector_port))
+        except Exception as e:
+            if opts.debug:
+                print(e)
+                the_type, value, tb = sys.exc_info()
+                traceback.print_tb(tb)
+            print("Error: {m}".format(m=e))
             sys.exit(2)
-        if status == "Warning":
-            sys.exit(1)
-        sys.exit(0)
\ No newline at end of file
+
+    #Print check result
+    result = run_node_check(opts, timer=timer)
+    print(result.output)
+    sys.exit(result.exit_code)
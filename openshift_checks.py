@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # Copyright (C) 2013:
@@ -30,22 +30,159 @@ version = "0.0.1"
 
 import sys
 import os
+import json
+import time
+import math
+import fcntl
+import select
+import socket
+import struct
+import threading
 
-try:
-    from pymongo import MongoClient
-except ImportError:
-    print("ERROR : this plugin needs the python-pymongo module. Please install it")
-    sys.exit(2)
+from urllib.parse import quote_plus
 
-try:
-    import paramiko
-except ImportError:
-    print("ERROR : this plugin needs the python-paramiko module. Please install it")
-    sys.exit(2)
+# pymongo and paramiko are slow to import, they are only loaded by the
+# helpers actually using them. A missing module raises an Exception, so
+# checks run in process report it instead of exiting.
+
+def import_pymongo():
+    try:
+        import pymongo
+    except ImportError:
+        raise Exception("this plugin needs the python-pymongo module. Please install it")
+    return pymongo
+
+
+def import_paramiko():
+    try:
+        import paramiko
+    except ImportError:
+        raise Exception("this plugin needs the python-paramiko module. Please install it")
+    return paramiko
 
 
 class MongoDBHelper(object):
 
+    # clients kept open by get_mongodb_client(shared=True)
+    _shared_clients = {}
+    _shared_clients_lock = threading.Lock()
+
+    @classmethod
+    def mongodb_uri(
+            cls,
+            mongodb_servers,
+            database_name=None,
+            username=None,
+            password=None,
+            source='admin',
+            replicaset=None,
+            read_preference=None,
+            connect_timeout=None,
+            server_selection_timeout=None
+    ):
+        """
+        Build a mongodb uri authenticating on connection
+        http://docs.mongodb.org/manual/reference/connection-string/
+
+        :param mongodb_servers: list of host:port
+        :param database_name: default database
+        :param username:
+        :param password:
+        :param source: authentication database
+        :param replicaset:
+        :param read_preference: e.g. primary, secondaryPreferred
+        :param connect_timeout: connection timeout in seconds
+        :param server_selection_timeout: server selection timeout in seconds
+        :return: mongodb uri string
+        """
+        credentials = ''
+        if username is not None:
+            credentials = "{u}:{p}@".format(
+                u=quote_plus(username),
+                p=quote_plus(password or '')
+            )
+
+        options = []
+        if username is not None:
+            options.append(('authSource', source))
+        if replicaset:
+            options.append(('replicaSet', replicaset))
+        if read_preference:
+            options.append(('readPreference', read_preference))
+        if connect_timeout:
+            options.append(('connectTimeoutMS', int(connect_timeout * 1000)))
+        if server_selection_timeout:
+            options.append(('serverSelectionTimeoutMS', int(server_selection_timeout * 1000)))
+
+        return "mongodb://{c}{h}/{d}{o}".format(
+            c=credentials,
+            h=','.join(mongodb_servers),
+            d=database_name or '',
+            o='?' + '&'.join(
+                "{k}={v}".format(k=k, v=quote_plus(str(v))) for k, v in options
+            ) if options else ''
+        )
+
+    @classmethod
+    def get_mongodb_client(
+            cls,
+            mongodb_servers=[],
+            replicaset=None,
+            username=None,
+            password=None,
+            source='admin',
+            read_preference=None,
+            connect_timeout=None,
+            server_selection_timeout=None,
+            shared=False
+    ):
+        """
+        Connect and authenticate in one step through a mongodb uri
+
+        :param mongodb_servers: list of host:port
+        :param replicaset:
+        :param username:
+        :param password:
+        :param source: authentication database
+        :param read_preference: e.g. primary, secondaryPreferred
+        :param connect_timeout: connection timeout in seconds
+        :param server_selection_timeout: server selection timeout in seconds
+        :param shared: keep the client open and return it to the next calls
+        with the same servers, replicaset and credentials. Do not close it.
+        :return: mongodb client
+        """
+        if isinstance(mongodb_servers, str):
+            mongodb_servers = [mongodb_servers]
+        if not mongodb_servers:
+            raise Exception("You must specify at least one mongodb server host")
+
+        uri = cls.mongodb_uri(
+            mongodb_servers,
+            username=username,
+            password=password,
+            source=source,
+            replicaset=replicaset,
+            read_preference=read_preference,
+            connect_timeout=connect_timeout,
+            server_selection_timeout=server_selection_timeout
+        )
+
+        if not shared:
+            try:
+                return import_pymongo().MongoClient(uri)
+            except Exception as e:
+                raise Exception("Could not connect to mongodb database")
+
+        with cls._shared_clients_lock:
+            mongodb_client = cls._shared_clients.get(uri)
+            if mongodb_client is None:
+                try:
+                    mongodb_client = import_pymongo().MongoClient(uri)
+                except Exception as e:
+                    raise Exception("Could not connect to mongodb database")
+                cls._shared_clients[uri] = mongodb_client
+            return mongodb_client
+
     @classmethod
     def get_mongodb_connection_to_db(
             cls,
@@ -65,7 +202,7 @@ class MongoDBHelper(object):
         if len(mongodb_servers) == 0:
             raise Exception("You must specify at least one mongodb server host")
         try:
-            mongodb_client = MongoClient(
+            mongodb_client = import_pymongo().MongoClient(
                 mongodb_servers,
                 replicaset=replicaset
             )
@@ -119,11 +256,195 @@ class MongoDBHelper(object):
             cls,
             mongodb_client
     ):
+        """
+        Close a mongodb client, the shared clients are kept open
+        :param mongodb_client: client to close, None when there is nothing to close
+        """
+        if mongodb_client is None:
+            return
+        with cls._shared_clients_lock:
+            if any(mongodb_client is c for c in cls._shared_clients.values()):
+                return
         try:
             mongodb_client.close()
         except Exception as e:
             raise Exception(e)
 
+    @classmethod
+    def districts_query(
+            cls,
+            district_names=None,
+            district_pattern=None
+    ):
+        """
+        Query matching the district names or the district name pattern, all the
+        districts without names nor pattern
+
+        :param district_names: list of district names
+        :param district_pattern: regular expression the district names must match
+        :return: query dict
+        """
+        query = {}
+        if district_names:
+            query = {
+                'name': {
+                    '$in': list(district_names)
+                }
+            }
+        elif district_pattern:
+            query = {
+                'name': {
+                    '$regex': district_pattern
+                }
+            }
+        return query
+
+
+class MongoDBCollectionWatcher(object):
+    """
+    Keep an always current in-memory copy of a collection for long running
+    processes. The collection is loaded once, then followed through a
+    change stream, or by tailing the replica set oplog when the server does
+    not support change streams. Reads never query mongodb.
+    """
+
+    def __init__(
+            self,
+            collection,
+            fields=None,
+            debug=False
+    ):
+        """
+
+        :param collection: pymongo collection to follow
+        :param fields: top level fields to keep in memory, all when None
+        """
+        self.collection = collection
+        self.fields = fields
+        self.debug = debug
+        self.mode = None
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def start(
+            self,
+            timeout=None
+    ):
+        """
+        Start following the collection in a background thread
+        :param timeout: seconds to wait for the initial load
+        :return: True once the collection is loaded
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self.ready.wait(timeout)
+
+    def get_documents(self):
+        """
+        :return: list of shallow copies of the current documents
+        """
+        with self.lock:
+            return [dict(document) for document in self.documents.values()]
+
+    def _keep(
+            self,
+            document
+    ):
+        if self.fields is None or document is None:
+            return document
+        return {
+            key: value for key, value in document.items()
+            if key == '_id' or key in self.fields
+        }
+
+    def _load(self):
+        documents = {
+            document['_id']: self._keep(document)
+            for document in self.collection.find()
+        }
+        with self.lock:
+            self.documents = documents
+        self.ready.set()
+
+    def _store(
+            self,
+            document
+    ):
+        with self.lock:
+            self.documents[document['_id']] = self._keep(document)
+
+    def _remove(
+            self,
+            document_id
+    ):
+        with self.lock:
+            self.documents.pop(document_id, None)
+
+    def run(self):
+        pymongo = import_pymongo()
+        while True:
+            try:
+                if self.mode != 'oplog':
+                    try:
+                        self._follow_change_stream()
+                    except (AttributeError, pymongo.errors.OperationFailure) as e:
+                        if self.debug:
+                            print("Change streams not available, tailing the oplog : {m}".format(m=e))
+                        self.mode = 'oplog'
+                if self.mode == 'oplog':
+                    self._follow_oplog()
+            except Exception as e:
+                if self.debug:
+                    print("Collection watcher error : {m}".format(m=e))
+                time.sleep(1)
+
+    def _follow_change_stream(self):
+        with self.collection.watch(full_document='updateLookup') as stream:
+            self.mode = 'change_stream'
+            # load once the stream is open so no change is missed
+            self._load()
+            for change in stream:
+                if change['operationType'] in ('insert', 'replace', 'update'):
+                    if change.get('fullDocument') is not None:
+                        self._store(change['fullDocument'])
+                elif change['operationType'] == 'delete':
+                    self._remove(change['documentKey']['_id'])
+                elif change['operationType'] in ('drop', 'rename', 'invalidate'):
+                    self._load()
+                    return
+
+    def _follow_oplog(self):
+        pymongo = import_pymongo()
+        oplog = self.collection.database.client['local']['oplog.rs']
+        namespace = self.collection.full_name
+
+        last = next(oplog.find().sort('$natural', pymongo.DESCENDING).limit(1))['ts']
+        self._load()
+
+        while True:
+            cursor = oplog.find(
+                {'ts': {'$gt': last}, 'ns': namespace},
+                cursor_type=pymongo.CursorType.TAILABLE_AWAIT
+            )
+            for entry in cursor:
+                last = entry['ts']
+                if entry['op'] == 'i':
+                    self._store(entry['o'])
+                elif entry['op'] == 'u':
+                    # updates only log the modifications, fetch the document once
+                    document = self.collection.find_one({'_id': entry['o2']['_id']})
+                    if document is None:
+                        self._remove(entry['o2']['_id'])
+                    else:
+                        self._store(document)
+                elif entry['op'] == 'd':
+                    self._remove(entry['o']['_id'])
+            if not cursor.alive:
+                time.sleep(1)
+
+
 class OutputFormatHelpers(object):
 
     @classmethod
@@ -152,7 +473,7 @@ class OutputFormatHelpers(object):
         :return: formated perf_data string
         """
         if UOM:
-            perf_data_template = "'{label}'={value}[{UOM}];{warn};{crit};{min};{max};"
+            perf_data_template = "'{label}'={value}{UOM};{warn};{crit};{min};{max};"
         else:
             perf_data_template = "'{label}'={value};{warn};{crit};{min};{max};"
 
@@ -205,8 +526,1677 @@ class OutputFormatHelpers(object):
             d=perfdata_string
         )
 
+    @classmethod
+    def exit_code(
+            cls,
+            state
+    ):
+        """
+        Nagios plugin exit code of a check state
+        :param state: State of the check in  ['Critical', 'Warning', 'OK', 'Unknown']
+        :return: exit code
+        """
+        return {
+            'OK': 0,
+            'Warning': 1,
+            'Critical': 2
+        }.get(state, 3)
+
+    @classmethod
+    def prometheus_string(
+            cls,
+            metric,
+            samples,
+            metric_type='gauge',
+            help=''
+    ):
+        """
+        Generate a metric in the prometheus text exposition format
+        https://prometheus.io/docs/instrumenting/exposition_formats/
+        :param metric: metric name
+        :param samples: Array of (labels dict, value)
+        :param metric_type: gauge, counter, ...
+        :param help: metric description
+        :return: formated metric string
+        """
+        lines = []
+        if help:
+            lines.append("# HELP {m} {h}".format(m=metric, h=help))
+        lines.append("# TYPE {m} {t}".format(m=metric, t=metric_type))
+        for labels, value in samples:
+            labels_string = ','.join(
+                '{k}="{v}"'.format(
+                    k=k,
+                    v=str(v).replace('\\', '\\\\').replace('"', '\\"')
+                ) for k, v in sorted(labels.items())
+            )
+            lines.append("{m}{{{l}}} {v}".format(m=metric, l=labels_string, v=value))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def worst_state(
+            cls,
+            states
+    ):
+        """
+        Return the most severe check state
+        :param states: iterable of states in ['Critical', 'Warning', 'OK', 'Unknown']
+        :return: most severe state, OK for an empty iterable
+        """
+        severity = ['OK', 'Unknown', 'Warning', 'Critical']
+        return max(states, key=severity.index, default='OK')
+
+    @classmethod
+    def multi_check_output_string(
+            cls,
+            state,
+            message,
+            results,
+            perfdata=None
+    ):
+        """
+        Generate a check output made of a summary line followed by one line
+        per sub check. The sub checks perf data are all reported on the
+        summary line, their labels must be unique.
+        :param state: State of the whole check
+        :param message: Summary message
+        :param results: Array of sub check dict with name, status, message and perfdata keys
+        :param perfdata: Array of extra perf data string of the whole check
+        :return: check output formated string
+        """
+        lines = [
+            cls.check_output_string(
+                state,
+                message,
+                [data for result in results for data in result['perfdata']] + (perfdata or [])
+            )
+        ]
+        lines += [
+            "{s}: {n} {m}".format(
+                s=result['status'],
+                n=result['name'],
+                m=result['message']
+            ) for result in results
+        ]
+        return '\n'.join(lines)
+
+    @classmethod
+    def districts_check_output(
+            cls,
+            results,
+            multi_district=False,
+            perfdata=None
+    ):
+        """
+        Format the districts check results
+
+        :param results: list of district_check results
+        :param multi_district: report a summary line followed by one line per
+        district instead of a single district output
+        :param perfdata: extra perf data of the whole check
+        :return: check state, check output string
+        """
+        if not multi_district:
+            result = results[0]
+            output = cls.check_output_string(
+                result['status'],
+                result['message'],
+                result['perfdata'] + (perfdata or [])
+            )
+            return result['status'], output
+
+        status = cls.worst_state(
+            [result['status'] for result in results]
+        )
+
+        message = "{nb} openshift districts, {c} critical, {w} warning".format(
+            nb=len(results),
+            c=sum(result['status'] == 'Critical' for result in results),
+            w=sum(result['status'] == 'Warning' for result in results)
+        )
+        output = cls.multi_check_output_string(
+            status,
+            message,
+            results,
+            perfdata
+        )
+        return status, output
+
+
+class CheckResult(object):
+    """
+    Result of a check run in process
+    """
+
+    def __init__(
+            self,
+            status,
+            output,
+            results=None
+    ):
+        """
+
+        :param status: State of the check in ['Critical', 'Warning', 'OK', 'Unknown']
+        :param output: plugin output, perf data included
+        :param results: list of the sub checks results
+        """
+        self.status = status
+        self.output = output
+        self.results = results or []
+
+    @property
+    def exit_code(self):
+        return OutputFormatHelpers.exit_code(self.status)
+
+    def __repr__(self):
+        return "CheckResult({s!r}, {o!r})".format(s=self.status, o=self.output)
+
+
+class PassiveCheckHelpers(object):
+    """
+    Submit many passive check results at once, either as external commands
+    or as a Nagios check result spool file. A result is a dict with the
+    host_name, service_description (missing for a host result), return_code
+    and output keys.
+    """
+
+    @classmethod
+    def external_command_string(
+            cls,
+            result,
+            timestamp
+    ):
+        """
+        :param result: check result dict
+        :param timestamp: check time, seconds since the epoch
+        :return: PROCESS_SERVICE_CHECK_RESULT or PROCESS_HOST_CHECK_RESULT line
+        """
+        output = cls.single_line(result['output'])
+        if result.get('service_description') is None:
+            return "[{t}] PROCESS_HOST_CHECK_RESULT;{h};{c};{o}\n".format(
+                t=int(timestamp),
+                h=result['host_name'],
+                c=result['return_code'],
+                o=output
+            )
+        return "[{t}] PROCESS_SERVICE_CHECK_RESULT;{h};{s};{c};{o}\n".format(
+            t=int(timestamp),
+            h=result['host_name'],
+            s=result['service_description'],
+            c=result['return_code'],
+            o=output
+        )
+
+    @classmethod
+    def spool_entry_string(
+            cls,
+            result,
+            timestamp
+    ):
+        """
+        :param result: check result dict
+        :param timestamp: check time, seconds since the epoch
+        :return: check result spool file entry
+        """
+        lines = [
+            "### Nagios {k} Check Result ###".format(
+                k='Host' if result.get('service_description') is None else 'Service'
+            ),
+            "host_name={h}".format(h=result['host_name'])
+        ]
+        if result.get('service_description') is not None:
+            lines.append("service_description={s}".format(s=result['service_description']))
+        lines += [
+            "check_type=1",
+            "check_options=0",
+            "scheduled_check=0",
+            "reschedule_check=0",
+            "latency=0.0",
+            "start_time={t:.1f}".format(t=timestamp),
+            "finish_time={t:.1f}".format(t=timestamp),
+            "early_timeout=0",
+            "exited_ok=1",
+            "return_code={c}".format(c=result['return_code']),
+            "output={o}".format(o=cls.single_line(result['output']))
+        ]
+        return '\n'.join(lines) + '\n\n'
+
+    @staticmethod
+    def single_line(
+            output
+    ):
+        """
+        :return: output on a single line, the newlines escaped
+        """
+        return output.replace('\\', '\\\\').replace('\n', '\\n')
+
+    @classmethod
+    def write_command_file(
+            cls,
+            command_file,
+            results,
+            timestamp=None
+    ):
+        """
+        Write all the results to the external command file (usually a named
+        pipe) in as few write calls as possible. Each write holds whole
+        lines and at most PIPE_BUF bytes, so it is atomic and never mixed
+        with the lines of the other writers of the pipe
+        :param command_file: path of the external command file
+        :param results: list of check result dict
+        :param timestamp: check time, now by default
+        :return: number of submitted results
+        """
+        timestamp = timestamp or time.time()
+        lines = [
+            cls.external_command_string(result, timestamp).encode('utf-8') for result in results
+        ]
+        if not lines:
+            return 0
+
+        chunks = []
+        chunk = b''
+        for line in lines:
+            if chunk and len(chunk) + len(line) > select.PIPE_BUF:
+                chunks.append(chunk)
+                chunk = b''
+            chunk += line
+        chunks.append(chunk)
+
+        fd = os.open(command_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            for chunk in chunks:
+                written = 0
+                while written < len(chunk):
+                    written += os.write(fd, chunk[written:])
+        finally:
+            os.close(fd)
+        return len(results)
+
+    @classmethod
+    def write_spool_dir(
+            cls,
+            spool_dir,
+            results,
+            timestamp=None
+    ):
+        """
+        Write all the results to one check result file of the spool
+        directory, then create its .ok file so the file is only read once
+        complete
+        :param spool_dir: Nagios check_result_path directory
+        :param results: list of check result dict
+        :param timestamp: check time, now by default
+        :return: number of submitted results
+        """
+        import random
+        import string
+
+        timestamp = timestamp or time.time()
+        if not results:
+            return 0
+
+        data = "### Active Check Result File ###\nfile_time={t}\n\n".format(
+            t=int(timestamp)
+        ) + ''.join(
+            cls.spool_entry_string(result, timestamp) for result in results
+        )
+
+        # nagios only reads the 7 characters long names starting with c
+        while True:
+            path = os.path.join(
+                spool_dir,
+                'c' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(6))
+            )
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except OSError as e:
+                if not os.path.exists(path):
+                    raise e
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        open(path + '.ok', 'w').close()
+        return len(results)
+
+
+class PhaseTimer(object):
+    """
+    Measure the wall time of the check phases. A phase run several times,
+    or from several threads, accumulates its durations.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def add(
+            self,
+            name,
+            seconds
+    ):
+        with self.lock:
+            if name not in self.phases:
+                self.order.append(name)
+                self.phases[name] = 0
+            self.phases[name] += seconds
+
+    def phase(
+            self,
+            name
+    ):
+        """
+        Context manager timing its block as the name phase
+        """
+        return _TimedPhase(self, name)
+
+    def wrap(
+            self,
+            name,
+            function
+    ):
+        """
+        :return: function timing each of its calls as the name phase
+        """
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def elapsed(self):
+        """
+        :return: seconds since the timer creation
+        """
+        return time.time() - self.start
+
+    def perf_data(
+            self,
+            prefix='',
+            warn='',
+            crit=''
+    ):
+        """
+        Generate the phases and total runtime perf data in milliseconds
+        :param prefix: label prefix
+        :param warn: Warning level of the total runtime in milliseconds
+        :param crit: Critical level of the total runtime in milliseconds
+        :return: Array of perf data string
+        """
+        with self.lock:
+            phases = [(name, self.phases[name]) for name in self.order]
+        phases.append(('total', self.elapsed()))
+
+        return [
+            OutputFormatHelpers.perf_data_string(
+                label="{p}{n}_time".format(p=prefix, n=name),
+                value=int(round(seconds * 1000)),
+                warn=warn if name == 'total' else '',
+                crit=crit if name == 'total' else '',
+                UOM='ms',
+                min=0
+            ) for name, seconds in phases
+        ]
+
+
+class _TimedPhase(object):
+
+    def __init__(
+            self,
+            timer,
+            name
+    ):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+class Deadline(object):
+    """
+    Time budget of a check, shared by its phases. A budget of None seconds
+    never expires.
+    """
+
+    def __init__(
+            self,
+            seconds=None
+    ):
+        self.end = None if seconds is None else time.time() + seconds
+
+    def remaining(self):
+        """
+        :return: seconds left, never negative, None without budget
+        """
+        if self.end is None:
+            return None
+        return max(self.end - time.time(), 0)
+
+    def expired(self):
+        return self.end is not None and time.time() >= self.end
+
+    def timeout(
+            self,
+            timeout=None,
+            share=1
+    ):
+        """
+        Bound a timeout by a share of the remaining time
+        :param timeout: wanted timeout in seconds, None to wait forever
+        :param share: part of the remaining time the timeout may use
+        :return: timeout in seconds, at least 10ms once bounded by the budget
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        remaining = max(remaining * share, 0.01)
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def split(
+            self,
+            parts
+    ):
+        """
+        :param parts: number of parts sharing the remaining time
+        :return: Deadline expiring once one part of the remaining time is spent
+        """
+        if self.end is None:
+            return Deadline()
+        return Deadline(self.remaining() / parts)
+
+
+class NodeTable(object):
+    """
+    Compact status table of a set of nodes : the node names are indexed once
+    and each status flag is an int bitset, bit i standing for names[i].
+    Comparing two views of the nodes is then a few bitwise operations.
+    """
+
+    def __init__(
+            self,
+            names
+    ):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.flags = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def bits(
+            self,
+            names
+    ):
+        """
+        :param names: iterable of node names, unknown names are ignored
+        :return: bitset of names
+        """
+        data = bytearray((len(self.names) + 7) // 8)
+        index = self.index
+        for name in names:
+            i = index.get(name)
+            if i is not None:
+                data[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(bytes(data), 'little')
+
+    def set(
+            self,
+            flag,
+            names
+    ):
+        """
+        Set the flag of names only
+        :return: bitset of the flag
+        """
+        self.flags[flag] = self.bits(names)
+        return self.flags[flag]
+
+    def get(
+            self,
+            flag
+    ):
+        """
+        :return: bitset of the flag, 0 when never set
+        """
+        return self.flags.get(flag, 0)
+
+    @staticmethod
+    def count(
+            bits
+    ):
+        """
+        :return: number of nodes in bits
+        """
+        return bin(bits).count('1')
+
+    def names_of(
+            self,
+            bits
+    ):
+        """
+        :return: list of the node names in bits, in index order
+        """
+        data = bits.to_bytes((len(self.names) + 7) // 8, 'little')
+        return [
+            name for i, name in enumerate(self.names)
+            if data[i >> 3] >> (i & 7) & 1
+        ]
+
+
+class OpenSSHControlClient(object):
+    """
+    Minimal paramiko.SSHClient look alike running commands through the
+    system ssh client and an OpenSSH ControlMaster socket. The first call
+    authenticates and leaves a master connection alive for control_persist
+    seconds, later calls, even from other processes, only open a new channel
+    on it. The key must be unencrypted or loaded in the ssh-agent.
+    """
+
+    def __init__(
+            self,
+            hostname,
+            port,
+            user,
+            control_path,
+            control_persist=600,
+            ssh_key_file=None,
+            keepalive=30,
+            connect_timeout=None
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.user = user
+        self.control_path = os.path.expanduser(control_path)
+        self.control_persist = control_persist
+        self.ssh_key_file = ssh_key_file
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+
+    def ssh_command(
+            self,
+            cmd,
+            get_pty=False
+    ):
+        """
+        Build the ssh command line running cmd on the remote host
+        :param cmd: remote command
+        :param get_pty: force a remote pseudo terminal
+        :return: argument list
+        """
+        args = [
+            'ssh',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={p}'.format(p=self.control_path),
+            '-o', 'ControlPersist={s}'.format(s=self.control_persist),
+            '-o', 'ServerAliveInterval={s}'.format(s=self.keepalive),
+            '-p', str(self.port),
+            '-l', self.user
+        ]
+        if self.connect_timeout:
+            args += ['-o', 'ConnectTimeout={s}'.format(s=int(math.ceil(self.connect_timeout)))]
+        if self.ssh_key_file and os.path.exists(os.path.expanduser(self.ssh_key_file)):
+            args += ['-i', os.path.expanduser(self.ssh_key_file)]
+        if get_pty:
+            args.append('-tt')
+        args += [self.hostname, cmd]
+        return args
+
+    def exec_command(
+            self,
+            cmd,
+            get_pty=False,
+            timeout=None
+    ):
+        """
+        Same contract as paramiko.SSHClient.exec_command : reading stdout
+        raises socket.timeout when the command did not end before timeout
+        :return: stdin, stdout, stderr file like objects
+        """
+        import subprocess
+
+        process = subprocess.Popen(
+            self.ssh_command(cmd, get_pty),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        return process.stdin, _ProcessOutput(process, timeout), process.stderr
+
+    def connect(self):
+        """
+        Open, or check, the master connection with a no-op remote command
+        :return: self
+        """
+        import subprocess
+
+        process = subprocess.Popen(
+            self.ssh_command('true'),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise Exception("connexion to {h} failed '{m}'".format(
+                h=self.hostname,
+                m=stderr.strip()
+            ))
+        return self
+
+    def close(self):
+        # The master connection is shared, let ControlPersist expire it
+        pass
+
+
+class _ProcessOutput(object):
+    """
+    Iterate over a process stdout, killing the process and raising
+    socket.timeout once timeout seconds are elapsed
+    """
+
+    def __init__(
+            self,
+            process,
+            timeout=None
+    ):
+        self.process = process
+        self.timed_out = False
+        self.timer = None
+        # paramiko ChannelFile look alike, stdout.channel.close() stops the command
+        self.channel = self
+        if timeout:
+            self.timer = threading.Timer(timeout, self._kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _kill(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def __iter__(self):
+        for line in self.process.stdout:
+            yield line
+        self.process.wait()
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.timed_out:
+            raise socket.timeout("remote command timed out")
+
+    def read(self):
+        return ''.join(self)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+
+class TrackedClient(object):
+    """
+    paramiko.SSHClient look alike keeping the channels of the commands it
+    started, so the ones still running can be closed at once
+    """
+
+    def __init__(
+            self,
+            client
+    ):
+        self.client = client
+        self.channels = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def exec_command(
+            self,
+            cmd,
+            get_pty=False,
+            timeout=None
+    ):
+        """
+        Same contract as paramiko.SSHClient.exec_command, a command started
+        after close_channels is closed at once
+        :return: stdin, stdout, stderr file like objects
+        """
+        stdin, stdout, stderr = self.client.exec_command(
+            cmd,
+            get_pty=get_pty,
+            timeout=timeout
+        )
+        channel = getattr(stdout, 'channel', None)
+        if channel is not None:
+            with self.lock:
+                self.channels.append(channel)
+                closed = self.closed
+            if closed:
+                channel.close()
+        return stdin, stdout, stderr
+
+    def close_channels(self):
+        """
+        Close the channels of the commands still running, and of the ones
+        started later
+        """
+        with self.lock:
+            self.closed = True
+            channels, self.channels = self.channels, []
+        for channel in channels:
+            try:
+                channel.close()
+            except Exception:
+                pass
+
+    def get_transport(self):
+        return self.client.get_transport()
+
+    def close(self):
+        self.client.close()
+
+
+class BorrowedClient(object):
+    """
+    paramiko.SSHClient look alike using a client owned by the caller, closing
+    it leaves the client open
+    """
+
+    def __init__(
+            self,
+            client
+    ):
+        self.client = client
+
+    def exec_command(
+            self,
+            cmd,
+            get_pty=False,
+            timeout=None
+    ):
+        return self.client.exec_command(
+            cmd,
+            get_pty=get_pty,
+            timeout=timeout
+        )
+
+    def get_transport(self):
+        return self.client.get_transport()
+
+    def close(self):
+        pass
+
+
+class ShellSessionClient(object):
+    """
+    paramiko.SSHClient look alike running all the commands through one
+    remote shell opened on client, instead of opening a new channel and
+    starting a new shell for each command. The commands run one after the
+    other, the end of each output is found with a unique marker line
+    carrying the command exit code.
+    """
+
+    # sessions kept open by get_shared_session
+    _shared_sessions = {}
+    _shared_sessions_lock = threading.Lock()
+
+    def __init__(
+            self,
+            client,
+            shell='/bin/sh',
+            debug=False,
+            skip_timeout=1
+    ):
+        """
+        :param client: paramiko client or look alike opening the shell
+        :param shell: remote shell command
+        :param skip_timeout: seconds to wait for the end of an output left
+        unread before the shell is dropped
+        """
+        self.client = client
+        self.shell = shell
+        self.debug = debug
+        self.skip_timeout = skip_timeout
+        self.lock = threading.Lock()
+        self._stdin = None
+        self._stdout = None
+        self._lines = None
+        self._ended = None
+
+    @classmethod
+    def get_shared_session(
+            cls,
+            client,
+            shell='/bin/sh',
+            debug=False
+    ):
+        """
+        Return the shell session already opened on client in this process,
+        else a new one kept for the next calls
+        :param client: paramiko client or look alike
+        :return: ShellSessionClient
+        """
+        with cls._shared_sessions_lock:
+            session = cls._shared_sessions.get(id(client))
+            if session is None or session.client is not client:
+                session = cls(client, shell, debug)
+                cls._shared_sessions[id(client)] = session
+            return session
+
+    @staticmethod
+    def command_script(
+            cmd,
+            marker
+    ):
+        """
+        Shell lines running cmd with its stdin closed, then printing the
+        marker and the cmd exit code
+        :return: string
+        """
+        return "{{ {c}\n}} </dev/null\nprintf '%s %d\\n' {m} \"$?\"\n".format(
+            c=cmd,
+            m=marker
+        )
+
+    def _open(self):
+        import queue
+
+        stdin, stdout, stderr = self.client.exec_command(self.shell)
+        lines = queue.Queue()
+        ended = threading.Event()
+        for stream, stream_lines in ((stdout, lines), (stderr, None)):
+            reader = threading.Thread(
+                target=self._read_stream,
+                args=(stream, stream_lines, ended)
+            )
+            reader.daemon = True
+            reader.start()
+        self._stdin, self._stdout, self._lines, self._ended = stdin, stdout, lines, ended
+
+    def _read_stream(
+            self,
+            stream,
+            lines,
+            ended
+    ):
+        # the shell stderr is only drained, and shown in debug mode
+        try:
+            for line in stream:
+                if lines is not None:
+                    lines.put(line)
+                elif self.debug:
+                    print("remote shell stderr : {l}".format(l=line.rstrip()))
+        except Exception as e:
+            if self.debug:
+                print("remote shell read failed '{m}'".format(m=e))
+        finally:
+            if lines is not None:
+                ended.set()
+                lines.put(None)
+
+    def _reset(self):
+        """
+        Drop the remote shell, the next command opens a new one
+        """
+        stdin, stdout = self._stdin, self._stdout
+        self._stdin = self._stdout = self._lines = self._ended = None
+        if stdout is None:
+            return
+        try:
+            stdin.close()
+            if hasattr(stdout, 'channel'):
+                stdout.channel.close()
+            elif hasattr(stdout, 'process'):
+                stdout.process.kill()
+        except Exception:
+            pass
+
+    def exec_command(
+            self,
+            cmd,
+            get_pty=False,
+            timeout=None
+    ):
+        """
+        Same contract as paramiko.SSHClient.exec_command, get_pty is ignored.
+        The command stdin is /dev/null and its stderr is only shown in debug
+        mode. BrokerQueueTimeout is raised when the shell stayed busy with
+        the other commands for timeout seconds, the command then has timeout
+        seconds to end. A command still running after timeout is abandoned
+        with its shell, the next command opens a new one.
+        :return: stdin, stdout, stderr file like objects
+        """
+        import io
+        import uuid
+
+        if not self.lock.acquire(timeout=timeout if timeout else -1):
+            raise BrokerQueueTimeout("remote shell busy")
+
+        marker = '__check_openshift_{u}__'.format(u=uuid.uuid4().hex)
+        try:
+            if self._ended is not None and self._ended.is_set():
+                self._reset()
+            if self._stdin is None:
+                self._open()
+            self._stdin.write(self.command_script(cmd, marker))
+            self._stdin.flush()
+        except Exception:
+            self._reset()
+            self.lock.release()
+            raise
+
+        stdout = _ShellCommandOutput(self, self._lines, marker, timeout)
+        return io.StringIO(), stdout, io.StringIO()
+
+    def get_transport(self):
+        return self.client.get_transport()
+
+    def close(self):
+        with self.lock:
+            self._reset()
+        self.client.close()
+
+
+class _ShellCommandOutput(object):
+    """
+    Iterate over the output of one ShellSessionClient command up to its
+    marker line, raising socket.timeout once timeout seconds are elapsed.
+    The session is free for the next command once the output is read.
+    """
+
+    def __init__(
+            self,
+            session,
+            lines,
+            marker,
+            timeout=None
+    ):
+        self.session = session
+        self.lines = lines
+        self.marker = marker
+        self.expire = time.time() + timeout if timeout else None
+        # time the command was sent to the shell
+        self.start_time = time.time()
+        self.exit_status = None
+        self.done = False
+        self.released = False
+        # paramiko ChannelFile look alike, stdout.channel.recv_exit_status()
+        self.channel = self
+
+    def _release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.exit_status is None:
+            # the command may still be running, its shell can not be reused
+            self.session._reset()
+        self.session.lock.release()
+
+    def _next_line(
+            self,
+            expire=None
+    ):
+        """
+        :return: next output line, None at the end of the output
+        """
+        import queue
+
+        while not self.done:
+            try:
+                line = self.lines.get(
+                    timeout=max(expire - time.time(), 0) if expire else None
+                )
+            except queue.Empty:
+                raise socket.timeout("remote command timed out")
+            if line is None:
+                self.done = True
+                return None
+            index = line.find(self.marker)
+            if index < 0:
+                return line
+            self.exit_status = int(line[index + len(self.marker):].strip())
+            self.done = True
+            if index:
+                return line[:index]
+        return None
+
+    def _skip(self):
+        """
+        Skip the output left by a reader stopping early, e.g. at the end of
+        a JSON document, so the shell can be reused
+        """
+        expire = time.time() + self.session.skip_timeout
+        if self.expire:
+            expire = min(expire, self.expire)
+        try:
+            while self._next_line(expire) is not None:
+                pass
+        except socket.timeout:
+            pass
+
+    def __iter__(self):
+        timed_out = False
+        try:
+            while True:
+                try:
+                    line = self._next_line(self.expire)
+                except socket.timeout:
+                    timed_out = True
+                    raise
+                if line is None:
+                    return
+                yield line
+        finally:
+            if not (self.done or timed_out):
+                self._skip()
+            self._release()
+
+    def read(self):
+        return ''.join(self)
+
+    def recv_exit_status(self):
+        for line in self:
+            pass
+        return self.exit_status if self.exit_status is not None else -1
+
+    def close(self):
+        if not self.done:
+            # stop the command with its shell, the reader then gets the end of the output
+            self.session._reset()
+
+
+class BrokerQueueTimeout(socket.timeout):
+    """
+    A broker call could not start before its timeout
+    """
+
+
+class BrokerCallLimiter(object):
+    """
+    Bound the broker calls of all the checks running on this host : at most
+    slots calls at the same time, each one holding the flock of one of the
+    slot files, and at most rate calls per second with bursts of burst
+    calls, from a token bucket shared through a small state file. A process
+    dying with a slot frees it. The files are created private to the user,
+    in a directory only the user can write.
+    """
+
+    # tokens, time of the last refill
+    BUCKET = struct.Struct('<dd')
+    # seconds between two tries to get a free slot
+    POLL_INTERVAL = 0.05
+
+    def __init__(
+            self,
+            path,
+            slots=0,
+            rate=0,
+            burst=None
+    ):
+        """
+
+        :param path: prefix of the slot and bucket files. Its directory is
+        created mode 0700 when missing and must not be writable by others
+        :param slots: broker calls at the same time, 0 for no limit
+        :param rate: broker calls per second, 0 for no limit
+        :param burst: broker calls the bucket allows at once. By default
+        rate, at least 1
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            raise Exception(
+                "broker call limiter directory {d} must be owned by the user and not "
+                "writable by others".format(d=directory)
+            )
+        self.slots = slots
+        self.rate = rate
+        self.burst = burst if burst else max(rate, 1)
+        self.lock = threading.Lock()
+        # seconds waited for a slot and a token, by all the calls of this process
+        self.waited = 0.0
+
+    def _take_slot(self):
+        """
+        :return: the locked file of a free slot, None when all are used
+        """
+        for i in range(self.slots):
+            slot = os.fdopen(
+                os.open(
+                    '{p}.slot{i}'.format(p=self.path, i=i),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                    0o600
+                ),
+                'a'
+            )
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except (IOError, OSError):
+                slot.close()
+        return None
+
+    def _take_token(self):
+        """
+        :return: 0 when a token was taken, else seconds before the next one
+        """
+        fd = os.open(self.path + '.bucket', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            data = os.pread(fd, self.BUCKET.size, 0)
+            tokens, last = self.burst, now
+            if len(data) == self.BUCKET.size:
+                tokens, last = self.BUCKET.unpack(data)
+            tokens = min(self.burst, tokens + max(now - last, 0) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / float(self.rate)
+            os.pwrite(fd, self.BUCKET.pack(tokens, now), 0)
+            return wait
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _sleep(
+            seconds,
+            expire=None
+    ):
+        if expire is not None:
+            left = expire - time.time()
+            if left <= 0:
+                raise BrokerQueueTimeout("broker call queue wait timed out")
+            seconds = min(seconds, left)
+        time.sleep(seconds)
+
+    def acquire(
+            self,
+            timeout=None
+    ):
+        """
+        Wait for a free slot then for a token
+
+        :param timeout: seconds to wait, BrokerQueueTimeout is raised when
+        they expire. By default wait forever
+        :return: the held slot, to give back to release
+        """
+        start = time.time()
+        expire = start + timeout if timeout else None
+        slot = None
+        try:
+            while self.slots:
+                slot = self._take_slot()
+                if slot is not None:
+                    break
+                self._sleep(self.POLL_INTERVAL, expire)
+            while self.rate:
+                wait = self._take_token()
+                if not wait:
+                    break
+                self._sleep(wait, expire)
+        except Exception:
+            self.release(slot)
+            raise
+        finally:
+            with self.lock:
+                self.waited += time.time() - start
+        return slot
+
+    @staticmethod
+    def release(slot):
+        if slot is not None:
+            slot.close()
+
+
+class RateLimitedClient(object):
+    """
+    paramiko.SSHClient look alike starting each command of client once the
+    limiter allows it. A command keeps its slot until its output is read.
+    """
+
+    def __init__(
+            self,
+            client,
+            limiter
+    ):
+        self.client = client
+        self.limiter = limiter
+
+    def exec_command(
+            self,
+            cmd,
+            get_pty=False,
+            timeout=None
+    ):
+        """
+        Same contract as paramiko.SSHClient.exec_command, timeout bounds the
+        wait in the queue and the command together. BrokerQueueTimeout is
+        raised when the command could not start before timeout.
+        :return: stdin, stdout, stderr file like objects, stdout.start_time
+        is the time the command left the queue
+        """
+        start = time.time()
+        slot = self.limiter.acquire(timeout)
+        started = time.time()
+        if timeout:
+            timeout = max(timeout - (started - start), 0.01)
+        try:
+            stdin, stdout, stderr = self.client.exec_command(
+                cmd,
+                get_pty=get_pty,
+                timeout=timeout
+            )
+        except Exception:
+            self.limiter.release(slot)
+            raise
+        return stdin, _LimitedOutput(stdout, slot, started), stderr
+
+    def get_transport(self):
+        return self.client.get_transport()
+
+    def close(self):
+        self.client.close()
+
+
+class _LimitedOutput(object):
+    """
+    Iterate over a command output, releasing its limiter slot once read
+    """
+
+    def __init__(
+            self,
+            stdout,
+            slot,
+            start_time
+    ):
+        self.stdout = stdout
+        self.slot = slot
+        # a client queuing the command again knows better when it started
+        self.start_time = getattr(stdout, 'start_time', start_time)
+
+    def __iter__(self):
+        try:
+            for line in self.stdout:
+                yield line
+        finally:
+            BrokerCallLimiter.release(self.slot)
+            self.slot = None
+
+    def read(self):
+        return ''.join(self)
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class FileTTLCache(object):
+    """
+    Small JSON file cache shared between processes. Entries expire after
+    ttl seconds, the file is locked with flock while read or updated and
+    stale entries are dropped on each update.
+    """
+
+    def __init__(
+            self,
+            path,
+            ttl,
+            namespace=''
+    ):
+        """
+
+        :param path: cache file path
+        :param ttl: entries time to live in seconds
+        :param namespace: prefix of the cache keys, e.g. the broker hostname
+        """
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.namespace = namespace
+
+    def _key(
+            self,
+            key
+    ):
+        return "{n}/{k}".format(n=self.namespace, k=key)
+
+    def _lock(
+            self,
+            exclusive
+    ):
+        lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock_file
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get_many(
+            self,
+            keys
+    ):
+        """
+        :param keys: iterable of keys
+        :return: dict of key -> value for the keys with a fresh entry
+        """
+        with self._lock(exclusive=False):
+            entries = self._load()
+        now = time.time()
+        fresh = {}
+        for key in keys:
+            entry = entries.get(self._key(key))
+            if entry is not None and now - entry[0] < self.ttl:
+                fresh[key] = entry[1]
+        return fresh
+
+    def get(
+            self,
+            key
+    ):
+        """
+        :return: the fresh value of key or None
+        """
+        return self.get_many([key]).get(key)
+
+    def set_many(
+            self,
+            values
+    ):
+        """
+        Store values and evict the stale entries
+        :param values: dict of key -> json serializable value
+        """
+        if not values:
+            return
+        import tempfile
+
+        with self._lock(exclusive=True):
+            now = time.time()
+            entries = {
+                key: entry for key, entry in self._load().items()
+                if now - entry[0] < self.ttl
+            }
+            entries.update(
+                (self._key(key), [now, value]) for key, value in values.items()
+            )
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path))
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)
+
+    def set(
+            self,
+            key,
+            value
+    ):
+        self.set_many({key: value})
+
+
+class StateFile(object):
+    """
+    JSON state persisted between check runs. locked() holds an exclusive
+    flock while the state is read, updated and written back.
+    """
+
+    def __init__(
+            self,
+            path
+    ):
+        self.path = os.path.expanduser(path)
+
+    def locked(self):
+        """
+        Context manager returning the state dict, saved back when the block
+        ends without exception
+        """
+        return _LockedState(self)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(
+            self,
+            state
+    ):
+        import tempfile
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path))
+        )
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+
+class _LockedState(object):
+
+    def __init__(
+            self,
+            state_file
+    ):
+        self.state_file = state_file
+
+    def __enter__(self):
+        self.lock_file = open(self.state_file.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.state = self.state_file.load()
+        return self.state
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.state_file.save(self.state)
+        finally:
+            self.lock_file.close()
+        return False
+
+
+class NodeStatusHistory(object):
+    """
+    Status history of the nodes kept in a memory mapped file shared between
+    processes. Each node owns a fixed size record : a hash of its name, its
+    name, the time of its last sample and of its last status change, then a
+    ring buffer of its last samples statuses, one byte each. Recording a run writes the new samples
+    in place, the file only grows when new nodes show up.
+    """
+
+    MAGIC = b'OSNH'
+    VERSION = 2
+    # the records are found by the hash of the node name, the name itself is
+    # only kept for display and cut to NAME_SIZE bytes
+    KEY_SIZE = 16
+    NAME_SIZE = 128
+    # magic, version, samples per node
+    HEADER = struct.Struct('<4sHH')
+    # name hash, name, last sample time, last change time, next ring slot, samples count
+    RECORD = struct.Struct('<{k}s{n}sIIHH'.format(k=KEY_SIZE, n=NAME_SIZE))
+
+    ACTIVE = 1
+    UNRESPONSIVE = 2
+
+    def __init__(
+            self,
+            path,
+            samples=64
+    ):
+        """
+
+        :param path: history file path
+        :param samples: samples kept per node, a file holding another number
+        of samples is reset
+        """
+        if not 2 <= samples <= 65535:
+            raise Exception("The status history must keep between 2 and 65535 samples")
+        self.path = os.path.expanduser(path)
+        self.samples = samples
+        self.record_size = self.RECORD.size + samples
+
+    def _lock(self):
+        lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _header(self):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.samples)
+
+    def _open(self):
+        """
+        :return: file descriptor of the history file, reset when its layout
+        does not match
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = os.pread(fd, self.HEADER.size, 0)
+        size = os.fstat(fd).st_size
+        if header != self._header() or (size - len(header)) % self.record_size:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, self._header(), 0)
+        return fd
+
+    @classmethod
+    def node_key(
+            cls,
+            name
+    ):
+        """
+        :return: record key of a node, the hash of its name
+        """
+        import hashlib
+
+        return hashlib.sha256(name.encode('utf-8')).digest()[:cls.KEY_SIZE]
+
+    def _ring(
+            self,
+            mm,
+            offset,
+            slot,
+            count
+    ):
+        """
+        :return: statuses of a record ring, oldest first
+        """
+        ring = offset + self.RECORD.size
+        if count < self.samples:
+            return mm[ring:ring + count]
+        return mm[ring + slot:ring + self.samples] + mm[ring:ring + slot]
+
+    def record(
+            self,
+            statuses,
+            timestamp=None
+    ):
+        """
+        Append one sample per node and summarize the nodes history
+
+        :param statuses: dict of node name -> True when active, False when
+        unresponsive
+        :param timestamp: time of the samples, now by default
+        :return: dict of node name -> dict with the samples number, the
+        status changes number, the flap rate and the seconds since the last
+        status change
+        """
+        import mmap
+
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        record_struct = self.RECORD
+        summary = {}
+
+        with self._lock():
+            fd = self._open()
+            try:
+                size = os.fstat(fd).st_size
+                nb_records = (size - self.HEADER.size) // self.record_size
+                mm = mmap.mmap(fd, size)
+                index = {}
+                for i in range(nb_records):
+                    offset = self.HEADER.size + i * self.record_size
+                    index[bytes(mm[offset:offset + self.KEY_SIZE])] = offset
+
+                keys = dict((name, self.node_key(name)) for name in statuses)
+                new_names = dict(
+                    (key, name) for name, key in keys.items() if key not in index
+                )
+                new_keys = list(new_names)
+                if new_keys:
+                    # one resize for all the new nodes
+                    mm.close()
+                    os.ftruncate(fd, size + len(new_keys) * self.record_size)
+                    mm = mmap.mmap(fd, size + len(new_keys) * self.record_size)
+                    for i, key in enumerate(new_keys):
+                        index[key] = size + i * self.record_size
+                        record_struct.pack_into(
+                            mm,
+                            index[key],
+                            key,
+                            new_names[key].encode('utf-8')[:self.NAME_SIZE],
+                            0, 0, 0, 0
+                        )
+
+                for name, active in statuses.items():
+                    offset = index[keys[name]]
+                    key, node_name, last_time, last_change, slot, count = \
+                        record_struct.unpack_from(mm, offset)
+                    status = self.ACTIVE if active else self.UNRESPONSIVE
+
+                    ring = offset + record_struct.size
+                    if not count or mm[ring + (slot - 1) % self.samples] != status:
+                        last_change = timestamp
+                    mm[ring + slot] = status
+                    slot = (slot + 1) % self.samples
+                    count = min(count + 1, self.samples)
+                    record_struct.pack_into(
+                        mm,
+                        offset,
+                        key,
+                        node_name,
+                        timestamp,
+                        last_change,
+                        slot,
+                        count
+                    )
+
+                    history = self._ring(mm, offset, slot, count)
+                    changes = sum(1 for i in range(1, count) if history[i] != history[i - 1])
+                    summary[name] = {
+                        'samples': count,
+                        'changes': changes,
+                        'flap_rate': changes / float(count - 1) if count > 1 else 0.0,
+                        'since_change': timestamp - last_change
+                    }
+                mm.flush()
+                mm.close()
+            finally:
+                os.close(fd)
+        return summary
+
+
 class SSHHelper(object):
 
+    # paramiko clients kept open by get_shared_client, each host has its
+    # own lock so the connections to several hosts run at the same time
+    _shared_clients = {}
+    _shared_clients_locks = {}
+    _shared_clients_lock = threading.Lock()
+
     @classmethod
     def get_client(
             cls,
@@ -222,6 +2212,55 @@ class SSHHelper(object):
         client = cls.connect(hostname, port, ssh_key_file, passphrase, user)
         return client
 
+    @classmethod
+    def get_shared_client(
+            cls,
+            hostname,
+            port,
+            ssh_key_file,
+            passphrase,
+            user,
+            keepalive=30,
+            allow_agent=False,
+            timeout=None,
+            exit_on_error=True
+    ):
+        """
+        Return an already authenticated client to hostname if one is still
+        alive in this process, else connect a new one and keep it for the
+        next calls. Each command then only opens a new channel.
+
+        :param keepalive: seconds between transport keepalive packets
+        :param timeout: tcp connect timeout in seconds
+        :param exit_on_error: see connect
+        :return: paramiko client
+        """
+        key = (hostname, port, user)
+        with cls._shared_clients_lock:
+            host_lock = cls._shared_clients_locks.setdefault(key, threading.Lock())
+
+        with host_lock:
+            client = cls._shared_clients.get(key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                cls.close(client)
+
+            client = cls.connect(
+                hostname=hostname,
+                port=port,
+                ssh_key_file=ssh_key_file,
+                passphrase=passphrase,
+                user=user,
+                keepalive=keepalive,
+                allow_agent=allow_agent,
+                timeout=timeout,
+                exit_on_error=exit_on_error
+            )
+            cls._shared_clients[key] = client
+            return client
+
     @classmethod
     def connect(
             cls,
@@ -229,7 +2268,11 @@ class SSHHelper(object):
             port,
             ssh_key_file,
             passphrase,
-            user
+            user,
+            keepalive=0,
+            allow_agent=False,
+            timeout=None,
+            exit_on_error=True
     ):
         """
 
@@ -239,17 +2282,24 @@ class SSHHelper(object):
         :param ssh_key_file:
         :param passphrase:
         :param user:
+        :param keepalive: seconds between transport keepalive packets, 0 to disable
+        :param allow_agent: use the running ssh-agent and ~/.ssh keys, they are
+        the only keys tried when ssh_key_file is missing
+        :param timeout: tcp connect timeout in seconds
+        :param exit_on_error: exit the plugin when the connection fails, else
+        raise an Exception
         :return:
         """
         # Maybe paramiko is missing, but now we relly need ssh...
-        if paramiko is None:
-            print("ERROR : this plugin needs the python-paramiko module. Please install it")
-            sys.exit(2)
+        paramiko = import_paramiko()
 
-        if not os.path.exists(os.path.expanduser(ssh_key_file)):
+        if ssh_key_file and os.path.exists(os.path.expanduser(ssh_key_file)):
+            ssh_key_file = os.path.expanduser(ssh_key_file)
+        elif allow_agent:
+            ssh_key_file = None
+        else:
             raise Exception("Error : missing ssh key file. please specify it with -i parameter")
 
-        ssh_key_file = os.path.expanduser(ssh_key_file)
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -265,7 +2315,9 @@ class SSHHelper(object):
             'port': port,
             'username': user,
             'key_filename': ssh_key_file,
-            'password': passphrase
+            'password': passphrase,
+            'allow_agent': allow_agent,
+            'look_for_keys': allow_agent
         }
 
         user_config = ssh_config.lookup(cfg['hostname'])
@@ -273,19 +2325,31 @@ class SSHHelper(object):
             if k in user_config:
                 cfg[k] = user_config[k]
 
+        if timeout:
+            cfg['timeout'] = timeout
+
         if 'proxycommand' in user_config:
             cfg['sock'] = paramiko.ProxyCommand(user_config['proxycommand'])
 
         try:
             client.connect(**cfg)
         except Exception as e:
+            if not exit_on_error:
+                raise Exception("connexion to {h} failed '{m}'".format(
+                    m=e,
+                    h=hostname
+                ))
             print("Error : connexion to {h} failed '{m}'".format(
                 m=e,
                 h=hostname
             ))
             sys.exit(2)
+
+        if keepalive:
+            client.get_transport().set_keepalive(keepalive)
         return client
 
+    @staticmethod
     def close(client):
         try:
             client.close()